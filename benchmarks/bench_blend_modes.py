@@ -0,0 +1,49 @@
+"""
+混合模式基准：合成开销与图层面积成正比，与画布尺寸无关
+
+分别在不同尺寸的画布上合成不同边长的图层，输出numpy内核（PIL路径）和
+torch后端的耗时，以及每像素耗时。用法：
+    python benchmarks/bench_blend_modes.py [--repeat 5]
+"""
+import argparse
+import numpy as np
+import torch
+from common import best_of, load_module
+
+MODES = ("normal", "multiply", "soft-light")
+LAYER_EDGES = (256, 512, 1024, 2048)
+CANVAS_EDGES = (2048, 4096)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    compositing = load_module("compositing")
+    tensor_compositor = load_module("tensor_compositor")
+    torch.set_grad_enabled(False)
+    rng = np.random.default_rng(0)
+
+    print(f"{'canvas':>7} {'mode':>10} {'layer':>6} {'MP':>6} {'numpy ms':>9} {'ns/px':>6} {'torch ms':>9} {'ns/px':>6}")
+    for canvas_edge in CANVAS_EDGES:
+        buffer = rng.integers(0, 256, (canvas_edge, canvas_edge, 4), dtype=np.uint8)
+        canvas = torch.from_numpy(buffer).float().div_(255).unsqueeze(0)
+        for mode in MODES:
+            for edge in LAYER_EDGES:
+                layer = rng.integers(0, 256, (edge, edge, 4), dtype=np.uint8)
+                premultiplied = tensor_compositor.premultiply(torch.from_numpy(layer).float().div_(255).unsqueeze(0))
+
+                numpy_time = best_of(lambda: compositing.composite_layer(buffer, layer, (0, 0), 0.8, mode),
+                                     args.repeat)
+                torch_time = best_of(lambda: tensor_compositor.alpha_over(canvas, premultiplied, (0, 0), 0.8, mode),
+                                     args.repeat)
+
+                pixels = edge * edge
+                print(f"{canvas_edge:>7} {mode:>10} {edge:>6} {pixels / 1e6:>6.2f} "
+                      f"{numpy_time * 1e3:>9.2f} {numpy_time / pixels * 1e9:>6.1f} "
+                      f"{torch_time * 1e3:>9.2f} {torch_time / pixels * 1e9:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
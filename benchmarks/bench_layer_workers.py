@@ -0,0 +1,51 @@
+"""
+并行准备图层基准：不同图层数下串行与线程池准备图层的耗时和加速比
+
+每个图层都经过缩放和旋转（LANCZOS），合成不分带，只比较图层准备的并行效果。用法：
+    python benchmarks/bench_layer_workers.py [--workers N] [--size 1024] [--canvas 4096] [--repeat 3]
+"""
+import argparse
+import torch
+from common import best_of, load_module
+
+LAYER_COUNTS = (1, 2, 4, 8, 16, 32)
+
+
+def main():
+    image_utils = load_module("image_utils")
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=image_utils.DEFAULT_LAYER_WORKERS,
+                        help="并行线程数（默认与节点的layer_workers=0相同）")
+    parser.add_argument("--size", type=int, default=1024, help="叠加图层边长")
+    parser.add_argument("--canvas", type=int, default=4096, help="画布边长")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    canvas = image_utils.create_canvas(args.canvas, args.canvas, "transparent")
+    print(f"workers={args.workers} layer={args.size}px canvas={args.canvas}px")
+    print(f"{'layers':>6} {'serial s':>9} {'parallel s':>11} {'speedup':>8}")
+
+    for count in LAYER_COUNTS:
+        overlays = [torch.rand(1, args.size, args.size, 4) for _ in range(count)]
+        step = max(args.canvas - args.size, 1) / max(count, 1)
+        configs = [{
+            "source": f"input_{i + 1}",
+            "position": {"x": round(i * step), "y": round(i * step)},
+            "size": {"width": round(args.size * 0.9), "height": round(args.size * 0.8)},
+            "rotation": 5 + 10 * i,
+            "opacity": 1.0,
+            "layer": i,
+        } for i in range(count)]
+
+        def run(workers):
+            image_utils.composite_images(canvas, overlays, configs, "lanczos", None, workers=workers, band_rows=0)
+
+        serial = best_of(lambda: run(1), args.repeat)
+        parallel = best_of(lambda: run(args.workers), args.repeat)
+        print(f"{count:>6} {serial:>9.3f} {parallel:>11.3f} {serial / parallel:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
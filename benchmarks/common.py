@@ -0,0 +1,51 @@
+"""
+基准测试公共工具
+
+插件模块依赖ComfyUI的folder_paths，需要在ComfyUI根目录下运行，例如：
+    python custom_nodes/ComfyUI-ImageCompositionCy/benchmarks/bench_blend_modes.py
+也可以通过环境变量 COMFYUI_PATH 指定ComfyUI目录。
+"""
+import importlib
+import importlib.util
+import os
+import sys
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 以独立的包名加载插件的nodes包，避免与ComfyUI自身的nodes.py重名
+PACKAGE_NAME = "imagecomposition_cy_nodes"
+
+
+def load_module(name):
+    """加载插件nodes包中的子模块
+
+    Args:
+        name: 子模块名，如 "compositing"
+
+    Returns:
+        模块对象
+    """
+    comfy_path = os.environ.get("COMFYUI_PATH", os.getcwd())
+    if comfy_path not in sys.path:
+        sys.path.insert(0, comfy_path)
+
+    if PACKAGE_NAME not in sys.modules:
+        package_dir = os.path.join(PLUGIN_DIR, "nodes")
+        spec = importlib.util.spec_from_file_location(PACKAGE_NAME, os.path.join(package_dir, "__init__.py"),
+                                                      submodule_search_locations=[package_dir])
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[PACKAGE_NAME] = package
+        spec.loader.exec_module(package)
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+
+
+def best_of(func, repeat=5):
+    """多次运行取最短耗时（秒），排除首次运行和调度抖动的影响"""
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
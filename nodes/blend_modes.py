@@ -0,0 +1,83 @@
+"""
+混合模式
+按 W3C Compositing and Blending 规范实现的可分离混合函数，
+同一组公式同时用于numpy（uint8缓冲区）和torch（预乘张量）两个后端
+"""
+
+
+def _multiply(cb, cs, xp):
+    return cb * cs
+
+
+def _screen(cb, cs, xp):
+    return cb + cs - cb * cs
+
+
+def _hard_light(cb, cs, xp):
+    return xp.where(cs <= 0.5, 2 * cb * cs, _screen(cb, 2 * cs - 1, xp))
+
+
+def _overlay(cb, cs, xp):
+    return _hard_light(cs, cb, xp)
+
+
+def _soft_light(cb, cs, xp):
+    d = xp.where(cb <= 0.25, ((16 * cb - 12) * cb + 4) * cb, xp.sqrt(cb))
+    return xp.where(cs <= 0.5,
+                    cb - (1 - 2 * cs) * cb * (1 - cb),
+                    cb + (2 * cs - 1) * (d - cb))
+
+
+def _darken(cb, cs, xp):
+    return xp.minimum(cb, cs)
+
+
+def _lighten(cb, cs, xp):
+    return xp.maximum(cb, cs)
+
+
+def _add(cb, cs, xp):
+    return (cb + cs).clip(max=1.0)
+
+
+def _difference(cb, cs, xp):
+    return abs(cb - cs)
+
+
+# 混合模式名称与前端Canvas的globalCompositeOperation保持一致（add对应lighter）
+BLEND_FUNCTIONS = {
+    "multiply": _multiply,
+    "screen": _screen,
+    "overlay": _overlay,
+    "soft-light": _soft_light,
+    "darken": _darken,
+    "lighten": _lighten,
+    "add": _add,
+    "difference": _difference,
+}
+
+BLEND_MODES = ("normal",) + tuple(BLEND_FUNCTIONS)
+
+
+def is_blend_mode(mode):
+    """是否为需要混合函数的非normal模式（未知模式按normal处理）"""
+    return mode in BLEND_FUNCTIONS
+
+
+def mix(cb, cs, ab, mode, xp):
+    """计算混合后的源颜色 Cs' = (1 - αb)·Cs + αb·B(Cb, Cs)
+
+    结果再以普通source-over方式合成到背景上，因此背景透明的区域
+    保持图层原色，只有两者重叠的部分才会产生混合效果。
+
+    Args:
+        cb: 背景颜色（直通alpha，0-1）
+        cs: 图层颜色（直通alpha，0-1）
+        ab: 背景alpha（0-1），可广播到颜色通道
+        mode: 混合模式名称
+        xp: 数组模块（numpy或torch）
+
+    Returns:
+        混合后的图层颜色
+    """
+    return (1 - ab) * cs + ab * BLEND_FUNCTIONS[mode](cb, cs, xp)
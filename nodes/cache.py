@@ -0,0 +1,91 @@
+"""
+进程内缓存
+按字节预算淘汰的线程安全LRU缓存，并记录命中统计
+"""
+import threading
+import weakref
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    按字节预算淘汰的LRU缓存
+
+    条目可以绑定一个"所有者"对象（例如输入张量）：只有当查询时传入的
+    仍是同一个存活对象时才算命中，避免对象释放后内存地址被复用导致误命中。
+    """
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, owner=None):
+        """查询缓存，未命中返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2]() is not owner:
+                # 所有者已被释放或替换，条目失效
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes, owner=None):
+        """写入缓存，超出预算时淘汰最久未使用的条目"""
+        if nbytes > self.max_bytes:
+            return
+
+        owner_ref = weakref.ref(owner) if owner is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, nbytes, owner_ref)
+            self._bytes += nbytes
+            self._evict()
+
+    def set_budget(self, max_bytes):
+        """调整字节预算"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """清空缓存（保留统计）"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            return {
+                "name": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
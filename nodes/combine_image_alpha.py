@@ -7,9 +7,24 @@ import numpy as np
 from PIL import Image
 import folder_paths
 import os
-import json
+import math
 from datetime import datetime
 import random
+from .preview_writer import preview_writer
+
+
+# mask尺寸与图像不一致时的插值方式
+MASK_RESIZE_MODES = {
+    "nearest": {"mode": "nearest"},
+    "bilinear": {"mode": "bilinear", "align_corners": False},
+    "area": {"mode": "area"},
+}
+
+# 网格预览图的最长边
+PREVIEW_GRID_MAX_EDGE = 2048
+
+# 动图预览每帧的显示时长（毫秒）
+PREVIEW_FRAME_DURATION = 100
 
 
 class CombineImageAlpha:
@@ -24,6 +39,21 @@ class CombineImageAlpha:
             "required": {
                 "image": ("IMAGE",),  # RGB图像
                 "mask": ("MASK",),    # Alpha mask (来自LoadImage)
+            },
+            "optional": {
+                "mask_resize": (list(MASK_RESIZE_MODES), {
+                    "default": "nearest"
+                }),
+                "preview_mode": (["all", "first_n", "grid", "animated"], {
+                    "default": "all"
+                }),
+                "preview_count": ("INT", {
+                    "default": 16,
+                    "min": 0,
+                    "max": 4096,
+                    "step": 1,
+                    "display": "number"
+                }),
             }
         }
     
@@ -33,91 +63,126 @@ class CombineImageAlpha:
     CATEGORY = "ImageCompositionCy"
     OUTPUT_NODE = True  # 重要：这样ComfyUI会为节点生成预览
     
-    def combine(self, image, mask):
+    def combine(self, image, mask, mask_resize="nearest", preview_mode="all", preview_count=16):
         """
         将RGB图像和mask组合
         内部创建RGBA但输出时保持兼容性
         """
-        batch_size = image.shape[0]
-        height = image.shape[1]
-        width = image.shape[2]
+        batch_size, height, width = image.shape[:3]
         
         # 确保mask的形状正确
         if len(mask.shape) == 2:
             mask = mask.unsqueeze(0)
         
-        # 调整mask尺寸匹配图像
-        if mask.shape[0] != batch_size:
-            if mask.shape[0] == 1:
-                mask = mask.repeat(batch_size, 1, 1)
-            else:
-                mask = mask[:batch_size]
+        # 多出的mask帧直接截掉；单帧mask保持一帧，写入时再广播到整个批次
+        if mask.shape[0] > batch_size:
+            mask = mask[:batch_size]
+        mask = mask.to(device=image.device, dtype=image.dtype)
         
         if mask.shape[1] != height or mask.shape[2] != width:
-            # 使用nearest neighbor插值调整大小
+            # 整批mask一次插值调整大小
             mask = torch.nn.functional.interpolate(
                 mask.unsqueeze(1),  # [B, H, W] -> [B, 1, H, W]
                 size=(height, width),
-                mode='nearest'
+                **MASK_RESIZE_MODES[mask_resize]
             ).squeeze(1)  # [B, 1, H, W] -> [B, H, W]
         
+        # 输出只分配一次：RGB直接复制进去，alpha写入第4个通道
+        rgba = torch.empty((batch_size, height, width, 4), dtype=image.dtype, device=image.device)
+        rgba[..., :3].copy_(image[..., :3])
+        
         # ComfyUI的mask是反转的（1=遮罩，0=显示）
         # 所以我们需要反转它来得到正确的alpha（1=不透明，0=透明）
-        alpha = 1.0 - mask
-        
-        # 添加通道维度
-        alpha = alpha.unsqueeze(-1)  # [B, H, W] -> [B, H, W, 1]
-        
-        # 创建RGBA图像
-        rgba = torch.cat([image, alpha], dim=-1)  # [B, H, W, 3] + [B, H, W, 1] -> [B, H, W, 4]
+        torch.sub(1.0, mask.expand(batch_size, height, width), out=rgba[..., 3])
         
         # 生成预览图像供前端显示
-        preview_images = self.generate_preview(rgba)
+        preview_images = self.generate_preview(rgba, preview_mode, preview_count)
         
         # 返回RGBA图像和预览信息
+        ui = { "images": preview_images }
+        if preview_mode == "animated":
+            ui["animated"] = (True,)
         return {
             "result": (rgba,),
-            "ui": { "images": preview_images }
+            "ui": ui
         }
     
-    def generate_preview(self, rgba_tensor):
+    def generate_preview(self, rgba_tensor, preview_mode="all", preview_count=16):
         """
         生成预览图像供前端显示
+        
+        整个批次一次转换为uint8，编码在线程池中并行完成；
+        可以只预览前N帧、拼成一张网格图或一个WebP动图。
         """
-        results = []
         temp_dir = folder_paths.get_temp_directory()
         
         # 生成唯一的前缀
         prefix = "_temp_" + ''.join(random.choice("abcdefghijklmnopqrstupvxyz") for _ in range(5))
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        
+        frames = rgba_tensor
+        if preview_mode != "all" and preview_count > 0:
+            frames = frames[:preview_count]
+        
+        if preview_mode == "grid":
+            frames = self._grid_cells(frames)
+        
+        # 一次性转换整个批次（在原设备上量化后再传回CPU）
+        frames_np = (frames.clamp(0.0, 1.0) * 255).to(torch.uint8).cpu().numpy()
         
-        # 处理批次中的每个图像
-        batch_size = rgba_tensor.shape[0]
-        for i in range(batch_size):
-            img_tensor = rgba_tensor[i]
-            
-            # 转换为PIL图像
-            img_np = (img_tensor.cpu().numpy() * 255).astype(np.uint8)
-            
-            if img_np.shape[-1] == 4:
-                # RGBA图像
-                pil_image = Image.fromarray(img_np, mode='RGBA')
-            else:
-                # RGB图像
-                pil_image = Image.fromarray(img_np[:, :, :3], mode='RGB')
-            
-            # 生成文件名
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            random_str = ''.join(random.choice("0123456789") for _ in range(4))
-            filename = f"{prefix}_{timestamp}_{random_str}.png"
-            filepath = os.path.join(temp_dir, filename)
-            
-            # 保存图像
-            pil_image.save(filepath, "PNG", compress_level=1)
-            
+        if preview_mode == "grid":
+            jobs = [(self._tile_grid(frames_np), "png", {"compress_level": 1})]
+        elif preview_mode == "animated":
+            pil_frames = [Image.fromarray(frame) for frame in frames_np]
+            jobs = [(pil_frames[0], "webp", {"save_all": True, "append_images": pil_frames[1:],
+                                             "duration": PREVIEW_FRAME_DURATION, "loop": 0,
+                                             "quality": 80, "method": 0})]
+        else:
+            jobs = [(frame, "png", {"compress_level": 1}) for frame in frames_np]
+        
+        results = []
+        futures = []
+        for i, (image, ext, params) in enumerate(jobs):
+            filename = f"{prefix}_{timestamp}_{i:04d}.{ext}"
+            futures.append(preview_writer.write_image(image, os.path.join(temp_dir, filename),
+                                                      ext.upper(), **params))
             results.append({
                 "filename": filename,
                 "subfolder": "",
                 "type": "temp"
             })
         
-        return results
\ No newline at end of file
+        # 前端收到结果后立即加载预览，需要等待写入完成
+        for future in futures:
+            future.result()
+        
+        return results
+    
+    def _grid_cells(self, frames):
+        """
+        将帧缩小到网格图不超过 PREVIEW_GRID_MAX_EDGE 的尺寸
+        """
+        count, height, width = frames.shape[:3]
+        cols = math.ceil(math.sqrt(count))
+        rows = math.ceil(count / cols)
+        scale = min(1.0, PREVIEW_GRID_MAX_EDGE / (cols * width), PREVIEW_GRID_MAX_EDGE / (rows * height))
+        if scale >= 1.0:
+            return frames
+        
+        size = (max(round(height * scale), 1), max(round(width * scale), 1))
+        return torch.nn.functional.interpolate(
+            frames.permute(0, 3, 1, 2), size=size, mode='area'
+        ).permute(0, 2, 3, 1)
+    
+    def _tile_grid(self, frames_np):
+        """
+        将 [N, H, W, C] 的帧拼成接近正方形的网格图
+        """
+        count, height, width, channels = frames_np.shape
+        cols = math.ceil(math.sqrt(count))
+        rows = math.ceil(count / cols)
+        
+        cells = np.zeros((rows * cols, height, width, channels), dtype=np.uint8)
+        cells[:count] = frames_np
+        return cells.reshape(rows, cols, height, width, channels).swapaxes(1, 2).reshape(
+            rows * height, cols * width, channels)
@@ -0,0 +1,218 @@
+"""
+合成内核模块
+在 uint8 RGBA numpy 缓冲区上按图层包围盒进行局部合成
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import blend_modes
+
+
+# 与 Pillow AlphaComposite.c 保持一致的定点精度
+PRECISION_BITS = 7
+
+# 应用图层透明度时alpha额外保留的小数位数
+OPACITY_BITS = 8
+
+# 分带并行合成的默认带高（行）
+BAND_ROWS = 256
+
+# 小于该像素数的区域直接串行合成，线程调度开销不划算
+MIN_PARALLEL_PIXELS = 512 * 512
+
+# 分带合成共用的线程池，只在需要更多线程时替换为更大的池
+_band_executor_pool = None
+_band_executor_workers = 0
+_band_lock = threading.Lock()
+
+
+def clip_box(canvas_size, position, size):
+    """计算图层在画布上的可见区域
+
+    Args:
+        canvas_size: 画布尺寸 (width, height)
+        position: 图层左上角位置 (x, y)，可以为负数
+        size: 图层尺寸 (width, height)
+
+    Returns:
+        tuple: (画布区域(x0, y0, x1, y1), 图层区域(x0, y0, x1, y1))，
+        完全位于画布之外时返回None
+    """
+    canvas_w, canvas_h = canvas_size
+    x, y = position
+    w, h = size
+
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + w, canvas_w)
+    y1 = min(y + h, canvas_h)
+
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    return (x0, y0, x1, y1), (x0 - x, y0 - y, x1 - x, y1 - y)
+
+
+def _div255(value):
+    """Pillow 的 SHIFTFORDIV255 近似除法"""
+    return ((value >> 8) + value) >> 8
+
+
+def alpha_over(dst, src, opacity=1.0):
+    """将src以alpha over方式合成到dst上（原地修改dst）
+
+    opacity为1时计算方式逐位复刻 Pillow 的 Image.alpha_composite，
+    因此结果与整幅画布合成完全一致。opacity小于1时透明度直接乘到
+    alpha平面上，并保留8位小数精度参与混合，不再截断为整数。
+
+    Args:
+        dst: uint8 数组 [H, W, 4]，目标区域（可以是画布的切片视图）
+        src: uint8 数组 [H, W, 4]，与dst同尺寸的图层区域
+        opacity: 图层整体透明度 (0-1)
+    """
+    src_a = src[..., 3]
+
+    if opacity >= 1.0:
+        # 完全不透明的图层直接复制，完全透明的图层无需处理
+        if src_a.min() == 255:
+            np.copyto(dst, src)
+            return
+        if src_a.max() == 0:
+            return
+        sa = src_a.astype(np.uint32)
+        scale = 1
+    else:
+        if opacity <= 0 or src_a.max() == 0:
+            return
+        # 定点alpha：额外保留8位小数，需要64位中间结果
+        scale = 1 << OPACITY_BITS
+        sa = np.rint(src_a * (opacity * scale)).astype(np.uint64)
+
+    da = dst[..., 3].astype(sa.dtype)
+
+    outa255 = sa * 255 + da * (255 * scale - sa)
+
+    # src alpha为0的像素coef1为0，结果保持dst不变
+    coef1 = sa * (255 * 255 * (1 << PRECISION_BITS))
+    coef1 //= np.maximum(outa255, 1)
+    coef2 = 255 * (1 << PRECISION_BITS) - coef1
+
+    for c in range(3):
+        tmp = src[..., c] * coef1
+        tmp += dst[..., c] * coef2
+        tmp += 0x80 << PRECISION_BITS
+        dst[..., c] = _div255(tmp) >> PRECISION_BITS
+
+    if scale == 1:
+        outa255 += 0x80
+        dst[..., 3] = _div255(outa255)
+    else:
+        outa255 += 255 * scale // 2
+        dst[..., 3] = outa255 // (255 * scale)
+
+
+def blend(dst, src, mode, opacity=1.0):
+    """将src以指定混合模式合成到dst上（原地修改dst）
+
+    先按 blend_modes.mix 计算混合颜色，再以source-over合成，
+    只在传入的区域上做浮点运算，开销与图层面积成正比。
+
+    Args:
+        dst: uint8 数组 [H, W, 4]，目标区域（可以是画布的切片视图）
+        src: uint8 数组 [H, W, 4]，与dst同尺寸的图层区域
+        mode: 混合模式名称（见 blend_modes.BLEND_FUNCTIONS）
+        opacity: 图层整体透明度 (0-1)
+    """
+    if opacity <= 0 or src[..., 3].max() == 0:
+        return
+
+    s = src.astype(np.float32) * np.float32(1 / 255)
+    d = dst.astype(np.float32) * np.float32(1 / 255)
+    sa = s[..., 3:] * np.float32(min(opacity, 1.0))
+    da = d[..., 3:]
+
+    mixed = blend_modes.mix(d[..., :3], s[..., :3], da, mode, np)
+    outa = sa + da * (1 - sa)
+    outc = sa * mixed + (1 - sa) * da * d[..., :3]
+    # 结果完全透明的像素保留原颜色，与 alpha_over 和跳过透明图层时一致
+    np.divide(outc, outa, out=outc, where=outa > 0)
+    np.copyto(outc, d[..., :3], where=outa == 0)
+
+    dst[..., :3] = np.rint(np.clip(outc, 0.0, 1.0) * 255)
+    dst[..., 3:] = np.rint(outa * 255)
+
+
+def _band_executor(workers):
+    """返回至少有 workers 个线程的共用线程池，旧池在已提交的任务完成后释放"""
+    global _band_executor_pool, _band_executor_workers
+    with _band_lock:
+        if _band_executor_workers < workers:
+            if _band_executor_pool is not None:
+                _band_executor_pool.shutdown(wait=False)
+            _band_executor_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ImageCompositorBand")
+            _band_executor_workers = workers
+        return _band_executor_pool
+
+
+def composite_region(dst, src, opacity=1.0, blend_mode="normal", workers=1, band_rows=BAND_ROWS):
+    """将src合成到同尺寸的dst区域（原地修改dst），大区域按水平条带并行
+
+    alpha_over 和 blend 都是逐像素运算，各条带独立处理后写回同一个缓冲区，
+    结果与整块串行合成逐位一致。numpy运算在大数组上释放GIL，多个条带可以
+    同时在多个核心上计算。
+
+    Args:
+        dst: uint8 数组 [H, W, 4]，目标区域（可以是画布的切片视图）
+        src: uint8 数组 [H, W, 4]，与dst同尺寸的图层区域
+        opacity: 图层整体透明度 (0-1)
+        blend_mode: 混合模式，未知模式按normal处理
+        workers: 线程数，1表示串行
+        band_rows: 每个条带的行数，0表示不分带
+    """
+    if blend_modes.is_blend_mode(blend_mode):
+        def kernel(d, s):
+            blend(d, s, blend_mode, opacity)
+    else:
+        def kernel(d, s):
+            alpha_over(d, s, opacity)
+
+    height = dst.shape[0]
+    if workers <= 1 or band_rows <= 0 or height <= band_rows or dst.shape[0] * dst.shape[1] < MIN_PARALLEL_PIXELS:
+        kernel(dst, src)
+        return
+
+    def run_bands(start):
+        # 每个任务按间隔处理条带，池比workers大时并发数也不超过workers
+        for y in range(start, height, band_rows * workers):
+            kernel(dst[y:y + band_rows], src[y:y + band_rows])
+
+    executor = _band_executor(workers)
+    futures = [executor.submit(run_bands, start)
+               for start in range(0, min(height, band_rows * workers), band_rows)]
+    for future in futures:
+        future.result()
+
+
+def composite_layer(buffer, layer, position, opacity=1.0, blend_mode="normal", workers=1, band_rows=BAND_ROWS):
+    """将单个图层合成到画布缓冲区，只处理图层包围盒与画布的交集
+
+    Args:
+        buffer: uint8 数组 [H, W, 4]，画布缓冲区（原地修改）
+        layer: uint8 数组 [h, w, 4]，已变换的图层
+        position: 图层左上角在画布上的位置 (x, y)
+        opacity: 图层整体透明度 (0-1)
+        blend_mode: 混合模式，未知模式按normal处理
+        workers: 分带并行合成的线程数，1表示串行
+        band_rows: 每个条带的行数，0表示不分带
+
+    Returns:
+        bool: 图层是否与画布相交
+    """
+    boxes = clip_box((buffer.shape[1], buffer.shape[0]), position,
+                     (layer.shape[1], layer.shape[0]))
+    if boxes is None:
+        return False
+
+    (x0, y0, x1, y1), (sx0, sy0, sx1, sy1) = boxes
+    composite_region(buffer[y0:y1, x0:x1], layer[sy0:sy1, sx0:sx1], opacity, blend_mode, workers, band_rows)
+    return True
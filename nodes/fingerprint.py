@@ -0,0 +1,76 @@
+"""
+文件指纹
+按 (路径, 大小, mtime_ns, inode) 缓存文件内容哈希，文件未变化时无需重新读取
+"""
+import hashlib
+import os
+from .cache import LRUCache
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# 哈希算法：sha256（默认）、blake2b，或安装了xxhash时可用的非加密哈希xxh3
+HASH_ALGORITHM = os.environ.get("IMAGE_COMPOSITOR_HASH", "sha256").lower()
+if HASH_ALGORITHM == "xxh3" and xxhash is None:
+    print("[ImageCompositor] 未安装xxhash，文件指纹改用blake2b")
+    HASH_ALGORITHM = "blake2b"
+
+# 流式读取文件的块大小
+CHUNK_SIZE = 1024 * 1024
+
+# 指纹缓存：每个条目只有路径和摘要，预算按条目的近似字节数计算
+fingerprint_cache = LRUCache("fingerprints", 4 * 1024 * 1024)
+
+
+def _new_hasher(algorithm):
+    if algorithm == "xxh3" and xxhash is not None:
+        return xxhash.xxh3_128()
+    if algorithm in ("xxh3", "blake2b"):
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithm=None):
+    """流式计算文件内容哈希，不会一次性读入整个文件
+
+    Args:
+        path: 文件路径
+        algorithm: 哈希算法，None表示使用 HASH_ALGORITHM
+
+    Returns:
+        十六进制摘要
+    """
+    m = _new_hasher(algorithm or HASH_ALGORITHM)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            m.update(view[:n])
+    return m.hexdigest()
+
+
+def file_fingerprint(path, algorithm=None):
+    """返回文件内容指纹，文件的stat信息未变化时直接取缓存
+
+    Args:
+        path: 文件路径
+        algorithm: 哈希算法，None表示使用 HASH_ALGORITHM
+
+    Returns:
+        十六进制摘要
+    """
+    algorithm = algorithm or HASH_ALGORITHM
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino, algorithm)
+
+    digest = fingerprint_cache.get(key)
+    if digest is None:
+        digest = hash_file(path, algorithm)
+        fingerprint_cache.put(key, digest, len(key[0]) + len(digest) + 64)
+    return digest
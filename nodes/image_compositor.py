@@ -1,8 +1,14 @@
 """
 图片合成节点的具体实现
 """
+import base64
+import hashlib
+import io
 import json
 from . import image_utils
+from . import strokes
+from . import tensor_compositor
+from .preview_writer import preview_writer
 from PIL import Image
 
 
@@ -33,6 +39,92 @@ class ImageCompositor:
             },
             "optional": {
                 "background_image": ("IMAGE",),
+                "batch_mode": ("BOOLEAN", {
+                    "default": False,
+                    "label_on": "batch",
+                    "label_off": "first frame"
+                }),
+                "backend": (["auto", "pil", "torch"], {
+                    "default": "auto"
+                }),
+                "resample": (list(image_utils.RESAMPLE_FILTERS.keys()), {
+                    "default": "lanczos"
+                }),
+                "cache_size_mb": ("INT", {
+                    "default": 512,
+                    "min": 0,
+                    "max": 65536,
+                    "step": 64,
+                    "display": "number"
+                }),
+                "preview_max_edge": ("INT", {
+                    "default": 1024,
+                    "min": 0,
+                    "max": 16384,
+                    "step": 64,
+                    "display": "number"
+                }),
+                "tile_size": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 16384,
+                    "step": 256,
+                    "display": "number"
+                }),
+                "layer_workers": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 64,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "band_rows": ("INT", {
+                    "default": 256,
+                    "min": 0,
+                    "max": 8192,
+                    "step": 16,
+                    "display": "number"
+                }),
+                "rgb_only": ("BOOLEAN", {
+                    "default": False,
+                    "label_on": "RGB",
+                    "label_off": "RGBA"
+                }),
+                "output_scale": ("FLOAT", {
+                    "default": 1.0,
+                    "min": 0.05,
+                    "max": 1.0,
+                    "step": 0.05,
+                    "display": "number"
+                }),
+                "crop_x": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 65536,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "crop_y": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 65536,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "crop_width": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 65536,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "crop_height": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 65536,
+                    "step": 1,
+                    "display": "number"
+                }),
             },
             "hidden": {
                 "unique_id": "UNIQUE_ID",
@@ -51,7 +143,10 @@ class ImageCompositor:
     CATEGORY = "ImageCompositionCy"
     OUTPUT_NODE = True  # 允许节点输出预览
     
-    def composite_images(self, input_count, composition_data, background_image=None, unique_id=None, **kwargs):
+    def composite_images(self, input_count, composition_data, background_image=None, unique_id=None,
+                         batch_mode=False, backend="auto", resample="lanczos", cache_size_mb=512,
+                         preview_max_edge=1024, tile_size=0, layer_workers=0, band_rows=256, rgb_only=False,
+                         output_scale=1.0, crop_x=0, crop_y=0, crop_width=0, crop_height=0, **kwargs):
         """
         Composite multiple images based on Canvas data
         """
@@ -67,8 +162,83 @@ class ImageCompositor:
         images_config = config.get("images", [])
         drawing_layer_data = config.get("drawingLayer", None)
         
-        # 收集输入图片预览数据（用于前端显示）
-        preview_images = []
+        # 图层、增量重绘和绘画层缓存共用一个进程级总预算（取各节点设置的最大值），
+        # 本节点设为0时不使用图层缓存和增量重绘，但不影响其他节点的缓存
+        image_utils.set_cache_budget(cache_size_mb * 1024 * 1024)
+        layer_cache = image_utils.layer_cache if cache_size_mb > 0 else None
+        
+        # 收集叠加图片（基于input_count），保留None占位以维持索引对应关系
+        overlay_images = [kwargs.get(f"overlay_image_{i}") for i in range(1, input_count + 1)]
+        # 过滤出非背景图的配置
+        overlay_configs = [cfg for cfg in images_config if cfg.get("source") != "background"]
+        
+        # 后台保存输入图片预览（缩略图），始终使用原始输入，编辑器按原图尺寸换算坐标
+        preview_images = self._save_batch_previews(background_image, overlay_images, preview_max_edge)
+        
+        canvas_size = (1024, 1024)
+        if background_image is not None:
+            canvas_size = image_utils.image_size(background_image)
+        drawing_size = canvas_size
+        drawing_box = None
+        is_strokes = isinstance(drawing_layer_data, dict) and "strokes" in drawing_layer_data
+        
+        # 草稿模式：每个输入只缩小一次，位置和尺寸按比例换算，只渲染裁剪区域
+        draft = output_scale < 1.0 or crop_x > 0 or crop_y > 0 or crop_width > 0 or crop_height > 0
+        if draft:
+            box = image_utils.draft_box(canvas_size, (crop_x, crop_y, crop_width, crop_height))
+            origin = box[:2]
+            if output_scale < 1.0:
+                overlay_images = [image_utils.draft_image(overlay, output_scale, cache=layer_cache)
+                                  if overlay is not None else None for overlay in overlay_images]
+            overlay_configs = [image_utils.draft_config(cfg, output_scale, origin) for cfg in overlay_configs]
+            if background_image is not None:
+                background_image = image_utils.draft_image(background_image, output_scale, box, layer_cache)
+            else:
+                background_image = image_utils.draft_canvas(
+                    image_utils.draft_size((box[2] - box[0], box[3] - box[1]), output_scale), layer_cache)
+            if is_strokes:
+                # 矢量笔画按草稿画布尺寸直接栅格化裁剪区域，比例为1时与整幅合成的对应区域一致
+                drawing_size = image_utils.draft_size(canvas_size, output_scale)
+                x0, y0 = round(box[0] * output_scale), round(box[1] * output_scale)
+                width, height = image_utils.image_size(background_image)
+                drawing_box = (x0, y0, x0 + width, y0 + height)
+        
+        # 绘画层只解码一次，所有路径共用
+        drawing = self._decode_drawing_layer(drawing_layer_data, drawing_size, drawing_box)
+        if draft and not is_strokes:
+            drawing = image_utils.draft_drawing(drawing, output_scale, box, image_utils.drawing_cache)
+        
+        # 张量后端：auto在批量模式下使用torch，单帧时使用PIL
+        use_torch = backend == "torch" or (backend == "auto" and batch_mode)
+        if tile_size > 0:
+            if batch_mode:
+                print("[ImageCompositor] 分块模式只用于单帧PIL路径，批量模式忽略tile_size")
+            elif use_torch:
+                print("[ImageCompositor] 张量后端不支持分块模式，改用PIL后端分块合成")
+                use_torch = False
+        if use_torch and tensor_compositor.needs_lanczos(overlay_images, overlay_configs, resample):
+            if backend == "auto":
+                print("[ImageCompositor] 张量后端不支持LANCZOS，auto改用PIL后端逐帧合成")
+                use_torch = False
+            else:
+                print("[ImageCompositor] 张量后端不支持LANCZOS，缩放/旋转图层以双三次插值代替")
+        
+        # 批量模式或torch后端：同一布局应用到输入批次的每一帧
+        if batch_mode or use_torch:
+            return self._composite_tensor(overlay_images, overlay_configs, drawing, background_image,
+                                          batch_mode, use_torch, resample, layer_cache, preview_images,
+                                          layer_workers, band_rows, rgb_only)
+        
+        # 分块模式：超大画布逐块合成，不构建整幅画布
+        if tile_size > 0:
+            return self._composite_tiled(overlay_images, overlay_configs, drawing, background_image,
+                                         resample, tile_size, preview_images, layer_workers, band_rows, rgb_only)
+        
+        # 增量重绘：同一节点再次运行时只重绘布局有变化的区域
+        if unique_id is not None and layer_cache is not None:
+            return self._composite_incremental(unique_id, overlay_images, overlay_configs, drawing,
+                                               background_image, resample, layer_cache, preview_images,
+                                               layer_workers, band_rows, rgb_only)
         
         # 记录背景图在画布上的显示位置和大小（用于前端显示）
         display_bounds = None
@@ -116,35 +286,11 @@ class ImageCompositor:
             
             # 将背景图以原始分辨率绘制到画布上
             canvas.paste(bg_img, (0, 0), bg_img)
-            
-            # 保存背景图片预览
-            bg_filename = image_utils.save_temp_image(bg_img, "bg")
-            preview_images.append({"image": bg_filename, "type": "background"})
         else:
             # 如果没有背景图，使用默认大小1024x1024
             canvas = image_utils.create_canvas(1024, 1024, "transparent")
         
-        # 收集叠加图片（基于input_count），保留None占位以维持索引对应关系
-        overlay_images = []
-        for i in range(1, input_count + 1):
-            img_key = f"overlay_image_{i}"
-            if img_key in kwargs and kwargs[img_key] is not None:
-                img = image_utils.tensor_to_pil(kwargs[img_key])
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-                overlay_images.append(img)
-                
-                # 保存输入图片预览
-                img_filename = image_utils.save_temp_image(img, f"input_{i}")
-                preview_images.append({"image": img_filename, "type": f"input_{i}"})
-            else:
-                # 保留None占位，确保索引对应
-                overlay_images.append(None)
-        
         # 执行图片合成（将叠加图片合成到画布上）
-        # 过滤出非背景图的配置
-        overlay_configs = [cfg for cfg in images_config if cfg.get("source") != "background"]
-        
         # 前端已经转换好坐标，直接使用
         if False and display_bounds and overlay_configs:  # 暂时禁用后端转换，因为前端已经处理
             # 调整图片配置，将前端显示坐标转换为实际图片坐标
@@ -188,50 +334,242 @@ class ImageCompositor:
                     pass  # 保持原始配置
                     
                 adjusted_configs.append(adjusted_config)
-            canvas = image_utils.composite_images(canvas, overlay_images, adjusted_configs)
+            canvas = image_utils.composite_images(canvas, overlay_images, adjusted_configs, resample, layer_cache,
+                                                  layer_workers, band_rows)
         else:
             # 前端已经处理了坐标转换，直接使用
-            canvas = image_utils.composite_images(canvas, overlay_images, overlay_configs)
+            canvas = image_utils.composite_images(canvas, overlay_images, overlay_configs, resample, layer_cache,
+                                                  layer_workers, band_rows)
         
         # 处理绘画层（在所有图片合成之后）
-        if drawing_layer_data:
-            try:
-                # 解析base64数据
-                import base64
-                import io
-                
-                # 移除data:image/png;base64,前缀
-                if drawing_layer_data.startswith('data:'):
-                    drawing_layer_data = drawing_layer_data.split(',')[1]
-                
-                # 解码base64
-                drawing_bytes = base64.b64decode(drawing_layer_data)
-                drawing_img = Image.open(io.BytesIO(drawing_bytes))
-                
-                # 确保是RGBA格式
-                if drawing_img.mode != 'RGBA':
-                    drawing_img = drawing_img.convert('RGBA')
-                
-                # 调整绘画层大小以匹配画布
-                if drawing_img.size != canvas.size:
-                    drawing_img = drawing_img.resize(canvas.size, Image.Resampling.LANCZOS)
-                
-                # 将绘画层合成到画布上
-                canvas = Image.alpha_composite(canvas, drawing_img)
-                
-            except Exception as e:
-                print(f"[ImageCompositor] 处理绘画层失败: {e}")
+        if drawing is not None:
+            # 将绘画层合成到画布上（只处理绘画内容所在区域）
+            canvas.alpha_composite(*drawing)
         
-        # 转换结果
-        result = image_utils.pil_to_tensor(canvas)
-        mask = image_utils.extract_mask(canvas)
+        # 转换结果：一次写入预分配的输出，蒙版为alpha通道的视图
+        result, mask = image_utils.canvas_to_output(canvas, rgb_only)
         
         # 准备UI更新数据
         ui_data = {
-            "images": preview_images
+            "images": preview_writer.ready(preview_images),
+            "layer_cache": [image_utils.layer_cache.stats()]
         }
         
         return {
             "ui": ui_data,
             "result": (result, mask)
-        }
\ No newline at end of file
+        }
+    
+    def _decode_drawing_layer(self, drawing_layer_data, size, box=None):
+        """
+        解码绘画层并调整到画布尺寸，结果按内容缓存
+        
+        绘画层可以是矢量笔画 {"width", "height", "strokes"}（按输出分辨率直接栅格化，
+        box 不为None时只栅格化画布上的该区域），也可以是旧版工作流中内嵌的base64 PNG。
+        
+        Returns:
+            (裁剪到非透明区域的RGBA图像, 左上角位置) 或 None
+        """
+        if not drawing_layer_data:
+            return None
+        
+        is_strokes = isinstance(drawing_layer_data, dict) and "strokes" in drawing_layer_data
+        if is_strokes:
+            digest = hashlib.blake2b(json.dumps(drawing_layer_data, sort_keys=True).encode(),
+                                     digest_size=16).hexdigest()
+        elif not isinstance(drawing_layer_data, str):
+            # 既不是矢量笔画也不是base64 PNG，忽略无法识别的绘画层
+            print(f"[ImageCompositor] 忽略无法识别的绘画层数据: {type(drawing_layer_data).__name__}")
+            return None
+        else:
+            digest = hashlib.blake2b(drawing_layer_data.encode(), digest_size=16).hexdigest()
+        key = (digest, tuple(size), box)
+        
+        cached = image_utils.drawing_cache.get(key)
+        if cached is not None:
+            return cached if cached[0] is not None else None
+        
+        try:
+            if is_strokes:
+                entry = strokes.rasterize_strokes(drawing_layer_data, size, box) or (None, None)
+                return self._cache_drawing_layer(key, entry)
+            
+            # 移除data:image/png;base64,前缀
+            if drawing_layer_data.startswith('data:'):
+                drawing_layer_data = drawing_layer_data.split(',')[1]
+            
+            drawing_bytes = base64.b64decode(drawing_layer_data)
+            drawing_img = Image.open(io.BytesIO(drawing_bytes))
+            
+            # 确保是RGBA格式
+            if drawing_img.mode != 'RGBA':
+                drawing_img = drawing_img.convert('RGBA')
+            
+            # 尺寸不一致时才缩放
+            if drawing_img.size != tuple(size):
+                drawing_img = drawing_img.resize(size, Image.Resampling.LANCZOS)
+            
+            # 只保留有内容的区域，合成时只处理这部分
+            bbox = drawing_img.getchannel('A').getbbox()
+            if bbox is None:
+                entry = (None, None)
+            else:
+                entry = (drawing_img.crop(bbox), bbox[:2])
+            
+        except Exception as e:
+            print(f"[ImageCompositor] 处理绘画层失败: {e}")
+            return None
+        
+        return self._cache_drawing_layer(key, entry)
+    
+    def _cache_drawing_layer(self, key, entry):
+        """
+        缓存绘画层 (图像, 位置)，空绘画层也缓存以免重复解码
+        """
+        nbytes = entry[0].width * entry[0].height * 4 if entry[0] is not None else 0
+        image_utils.drawing_cache.put(key, entry, nbytes)
+        return entry if entry[0] is not None else None
+    
+    def _composite_incremental(self, unique_id, overlays, overlay_configs, drawing, background_image, resample,
+                               layer_cache, preview_images, layer_workers, band_rows, rgb_only):
+        """
+        增量合成（单帧PIL路径）：按unique_id保存上一次的布局和画布，
+        只重绘有变化的图层新旧包围盒
+        """
+        canvas_size = (1024, 1024)
+        if background_image is not None:
+            canvas_size = image_utils.image_size(background_image)
+        
+        buffer = image_utils.composite_incremental(unique_id, background_image, overlays, overlay_configs,
+                                                   drawing, resample, layer_cache, canvas_size, layer_workers,
+                                                   band_rows)
+        
+        return {
+            "ui": {
+                "images": preview_writer.ready(preview_images),
+                "layer_cache": [image_utils.layer_cache.stats()],
+                "render_cache": [image_utils.render_cache.stats()]
+            },
+            "result": image_utils.canvas_to_output(buffer, rgb_only)
+        }
+    
+    def _composite_tiled(self, overlays, overlay_configs, drawing, background_image, resample, tile_size,
+                         preview_images, layer_workers, band_rows, rgb_only):
+        """
+        分块合成（单帧PIL路径）：每块只处理与之相交的图层，
+        结果直接写入预分配的输出张量
+        """
+        canvas_size = (1024, 1024)
+        if background_image is not None:
+            canvas_size = image_utils.image_size(background_image)
+        
+        result, mask = image_utils.composite_tiles(background_image, overlays, overlay_configs, drawing,
+                                                   tile_size, resample, canvas_size, layer_workers, band_rows,
+                                                   rgb_only)
+        
+        return {
+            "ui": {"images": preview_writer.ready(preview_images)},
+            "result": (result, mask)
+        }
+    
+    def _composite_tensor(self, overlays, overlay_configs, drawing, background_image, batch_mode, use_torch,
+                          resample, layer_cache, preview_images, layer_workers, band_rows, rgb_only):
+        """
+        张量合成：布局JSON广播到整个批次，单帧输入自动广播，
+        所有帧在输入所在设备上一次完成合成
+        """
+        # 非批量模式只合成第一帧（单帧输入保持原张量，以便命中图层缓存）
+        if not batch_mode:
+            def first_frame(tensor):
+                if tensor is None or tensor.shape[0] == 1:
+                    return tensor
+                return tensor[:1]
+            background_image = first_frame(background_image)
+            overlays = [first_frame(overlay) for overlay in overlays]
+        
+        if not use_torch:
+            # 选择PIL后端时逐帧使用PIL路径
+            return self._composite_frames(overlay_configs, drawing, background_image, overlays, resample,
+                                          preview_images, layer_workers, band_rows, rgb_only)
+        
+        canvas = tensor_compositor.composite_batch(background_image, overlays, overlay_configs,
+                                                   resample=resample, cache=layer_cache)
+        
+        # 绘画层合成到所有帧
+        if drawing is not None:
+            drawing_img, offset = drawing
+            layer = tensor_compositor.premultiply(image_utils.pil_to_tensor(drawing_img).to(canvas.device))
+            tensor_compositor.alpha_over(canvas, layer, offset)
+        
+        result, mask = tensor_compositor.premultiplied_to_output(canvas, rgb_only)
+        
+        return {
+            "ui": {
+                "images": preview_writer.ready(preview_images),
+                "layer_cache": [image_utils.layer_cache.stats()]
+            },
+            "result": (result, mask)
+        }
+    
+    def _composite_frames(self, overlay_configs, drawing, background_image, overlays, resample, preview_images,
+                          layer_workers, band_rows, rgb_only):
+        """
+        逐帧调用PIL路径合成批次（PIL后端）
+        """
+        batch = tensor_compositor.batch_size_of([background_image] + overlays)
+        
+        def frame(tensor, index):
+            if tensor is None:
+                return None
+            return tensor[index if tensor.shape[0] > 1 else 0]
+        
+        canvas_size = (1024, 1024)
+        if background_image is not None:
+            canvas_size = (background_image.shape[-2], background_image.shape[-3])
+        
+        # 各帧直接写入预分配的批次输出
+        result, mask = image_utils.allocate_output(batch, canvas_size[1], canvas_size[0], rgb_only)
+        for i in range(batch):
+            bg_img = None
+            if background_image is not None:
+                bg_img = image_utils.tensor_to_pil(frame(background_image, i))
+                if bg_img.mode != 'RGBA':
+                    bg_img = bg_img.convert('RGBA')
+                canvas = image_utils.create_canvas(bg_img.width, bg_img.height, "transparent")
+                canvas.paste(bg_img, (0, 0), bg_img)
+            else:
+                canvas = image_utils.create_canvas(1024, 1024, "transparent")
+            
+            overlay_images = []
+            for overlay in overlays:
+                img = None
+                if overlay is not None:
+                    img = image_utils.tensor_to_pil(frame(overlay, i))
+                    if img.mode != 'RGBA':
+                        img = img.convert('RGBA')
+                overlay_images.append(img)
+            
+            canvas = image_utils.composite_images(canvas, overlay_images, overlay_configs, resample,
+                                                  workers=layer_workers, band_rows=band_rows)
+            
+            if drawing is not None:
+                canvas.alpha_composite(*drawing)
+            
+            image_utils.write_output(canvas, result, mask, i)
+        
+        return {
+            "ui": {"images": preview_writer.ready(preview_images)},
+            "result": (result, mask)
+        }
+    
+    def _save_batch_previews(self, background_image, overlays, preview_max_edge):
+        """
+        保存批次首帧的输入预览
+        """
+        preview_images = []
+        if background_image is not None:
+            preview_images.append(preview_writer.preview(background_image, "background", preview_max_edge))
+        for i, overlay in enumerate(overlays, start=1):
+            if overlay is not None:
+                preview_images.append(preview_writer.preview(overlay, f"input_{i}", preview_max_edge))
+        return preview_images
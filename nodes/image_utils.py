@@ -3,11 +3,58 @@
 提供图像格式转换、变换、合成等功能
 """
 import torch
+import torch.nn.functional as F
 import numpy as np
 from PIL import Image
 import folder_paths
 import os
+import math
+import json
+import hashlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from . import compositing
+from .cache import LRUCache
+
+
+# 节点的 cache_size_mb 是以下三个缓存的总预算，按比例分配
+CACHE_BUDGET_SHARES = {"layers": 0.5, "renders": 0.375, "drawing": 0.125}
+
+# 变换后图层的进程内缓存
+layer_cache = LRUCache("layers", 256 * 1024 * 1024)
+
+# 解码后的绘画层缓存（按内容哈希和画布尺寸）
+drawing_cache = LRUCache("drawing", 64 * 1024 * 1024)
+
+# 每个节点实例（unique_id）上一次的布局和合成结果，用于增量重绘
+render_cache = LRUCache("renders", 192 * 1024 * 1024)
+
+# 各节点请求过的最大总预算（见 set_cache_budget）
+_cache_budget = 0
+_cache_budget_lock = threading.Lock()
+
+# 并行准备图层的默认线程数（节点参数为0时使用）
+DEFAULT_LAYER_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def set_cache_budget(max_bytes):
+    """按 CACHE_BUDGET_SHARES 将总预算分配给图层、增量重绘和绘画层缓存
+    
+    缓存由进程内所有节点共用，预算只会增大到各节点请求的最大值：
+    某个节点设置较小的预算（或0）不会淘汰其他节点的缓存条目。
+    
+    Args:
+        max_bytes: 节点请求的总字节预算
+    """
+    global _cache_budget
+    with _cache_budget_lock:
+        if max_bytes <= _cache_budget:
+            return
+        _cache_budget = max_bytes
+        for cache in (layer_cache, render_cache, drawing_cache):
+            cache.set_budget(int(max_bytes * CACHE_BUDGET_SHARES[cache.name]))
 
 
 def tensor_to_pil(tensor):
@@ -96,62 +143,209 @@ def create_canvas(width, height, background="#FFFFFF"):
     return canvas
 
 
-def apply_transform(image, config):
+# 图层重采样滤波器，可按节点或按图层（配置中的"resample"字段）选择
+RESAMPLE_FILTERS = {
+    "lanczos": Image.Resampling.LANCZOS,
+    "bicubic": Image.Resampling.BICUBIC,
+    "bilinear": Image.Resampling.BILINEAR,
+    "nearest": Image.Resampling.NEAREST,
+}
+
+
+def layer_resample(config, default="lanczos"):
+    """获取图层使用的重采样滤波器名称
+    
+    Args:
+        config: 图层配置，可包含"resample"字段覆盖节点设置
+        default: 节点级默认滤波器
+    
+    Returns:
+        滤波器名称（RESAMPLE_FILTERS的键）
+    """
+    resample = config.get("resample") or default
+    if resample not in RESAMPLE_FILTERS:
+        resample = "lanczos"
+    return resample
+
+
+def layer_geometry(src_size, config):
+    """计算图层变换后的尺寸、位置和仿射矩阵
+    
+    缩放、旋转和平移合并为一个仿射矩阵，旋转以图层中心为轴（与前端Canvas一致）。
+    
+    Args:
+        src_size: 源图尺寸 (width, height)
+        config: 变换配置字典（position/size/rotation）
+    
+    Returns:
+        tuple: (输出尺寸(w, h), 左上角位置(x, y), 仿射矩阵)，
+        未旋转时矩阵为None，只需缩放到输出尺寸
+    """
+    src_w, src_h = src_size
+    position = config.get("position", {"x": 0, "y": 0})
+    size = config.get("size", None)
+    rotation = config.get("rotation", 0)
+    
+    width, height = src_w, src_h
+    if size and (size.get("width") != src_w or size.get("height") != src_h):
+        width = int(size.get("width", src_w))
+        height = int(size.get("height", src_h))
+    
+    if rotation == 0:
+        return (width, height), (int(position["x"]), int(position["y"])), None
+    
+    # 旋转后外接矩形（以图层中心为轴）
+    theta = math.radians(rotation)
+    cos_t, sin_t = math.cos(theta), math.sin(theta)
+    cx = position["x"] + width / 2
+    cy = position["y"] + height / 2
+    half_w = (abs(width * cos_t) + abs(height * sin_t)) / 2
+    half_h = (abs(width * sin_t) + abs(height * cos_t)) / 2
+    x0, y0 = math.floor(cx - half_w), math.floor(cy - half_h)
+    x1, y1 = math.ceil(cx + half_w), math.ceil(cy + half_h)
+    
+    # 输出像素 -> 源图像素：先平移到中心，逆旋转，再按缩放比例映射回源图
+    kx, ky = src_w / max(width, 1), src_h / max(height, 1)
+    ox, oy = x0 - cx, y0 - cy
+    matrix = (
+        kx * cos_t, kx * sin_t, kx * (cos_t * ox + sin_t * oy + width / 2),
+        -ky * sin_t, ky * cos_t, ky * (-sin_t * ox + cos_t * oy + height / 2),
+    )
+    
+    return (x1 - x0, y1 - y0), (x0, y0), matrix
+
+
+def apply_transform(image, config, resample="lanczos"):
     """应用变换到图片
     
+    缩放和旋转合并为一次仿射重采样，不再先缩放再旋转两次重采样。
+    透明度不在这里处理，而是在合成时直接乘到alpha上（见 compositing.alpha_over）。
+    
     Args:
         image: PIL.Image对象
         config: 变换配置字典，包含:
             - size: {width, height}
             - rotation: 旋转角度
-            - opacity: 透明度 (0-1)
+            - resample: 重采样滤波器（可选，覆盖节点设置）
+        resample: 节点级重采样滤波器 (nearest/bilinear/bicubic/lanczos)
     
     Returns:
         tuple: (变换后的图片, 位置(x, y))
     """
-    img = image.copy()
+    img = image
     
     # 获取变换参数
-    position = config.get("position", {"x": 0, "y": 0})
-    size = config.get("size", None)
-    rotation = config.get("rotation", 0)
-    opacity = config.get("opacity", 1.0)
+    resample_filter = RESAMPLE_FILTERS[layer_resample(config, resample)]
+    size, pos, matrix = layer_geometry(img.size, config)
     
-    # 调整尺寸
-    if size and (size.get("width") != img.width or size.get("height") != img.height):
-        new_width = int(size.get("width", img.width))
-        new_height = int(size.get("height", img.height))
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    # 旋转
-    if rotation != 0:
-        img = img.rotate(-rotation, expand=True, fillcolor=(0, 0, 0, 0))
-    
-    # 调整透明度
-    if opacity < 1.0:
+    if matrix is None:
+        # 只缩放：一次重采样
+        if size != img.size:
+            img = img.resize(size, resample_filter)
+    else:
         if img.mode != 'RGBA':
             img = img.convert('RGBA')
-        alpha = img.split()[-1]
-        alpha = Image.eval(alpha, lambda a: int(a * opacity))
-        img.putalpha(alpha)
+        
+        # 仿射采样不做抗锯齿：大幅缩小时先按整数倍reduce（盒式滤波，开销很小）
+        reduced = _affine_prefilter(img, matrix)
+        if reduced is not img:
+            img = reduced
+            size, pos, matrix = layer_geometry(img.size, config)
+        
+        # 仿射变换不支持LANCZOS，改用BICUBIC
+        if resample_filter == Image.Resampling.LANCZOS:
+            resample_filter = Image.Resampling.BICUBIC
+        
+        # 缩放、旋转、平移一次完成
+        img = img.transform(size, Image.Transform.AFFINE, matrix,
+                            resample=resample_filter, fillcolor=(0, 0, 0, 0))
     
-    return img, (int(position["x"]), int(position["y"]))
+    return img, pos
 
 
-def composite_images(canvas, overlay_images, images_config):
-    """将多张图片合成到画布上
+def _affine_prefilter(img, matrix):
+    """仿射变换前的整数倍reduce，缩小倍数不足2时原样返回"""
+    factor = int(min(math.hypot(matrix[0], matrix[1]), math.hypot(matrix[3], matrix[4])))
+    if factor >= 2:
+        return img.reduce(factor)
+    return img
+
+
+def layer_source(image, config):
+    """准备分块渲染使用的图层源图
+    
+    转换为RGBA，旋转图层预先做 apply_transform 中的整数倍reduce，
+    之后每个分块只需调用 transform_region。
     
     Args:
-        canvas: PIL.Image画布
-        overlay_images: 叠加图片列表
-        images_config: 图片配置列表
+        image: PIL.Image或ComfyUI的IMAGE张量
+        config: 图层配置
     
     Returns:
-        合成后的PIL.Image
+        RGBA模式的PIL.Image
     """
-    if not overlay_images or not images_config:
-        return canvas
+    img = tensor_to_pil(image) if isinstance(image, torch.Tensor) else image
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    
+    _, _, matrix = layer_geometry(img.size, config)
+    if matrix is not None:
+        img = _affine_prefilter(img, matrix)
+    return img
+
+
+def transform_region(source, config, region, resample="lanczos"):
+    """只渲染变换后图层落在画布区域 region 内的部分
+    
+    缩放图层用 resize 的 box 参数只计算需要的输出像素，旋转图层平移仿射矩阵，
+    结果与 apply_transform 整幅变换后再裁剪一致（缩放图层可能有1级舍入差异）。
+    
+    Args:
+        source: layer_source 返回的RGBA源图
+        config: 图层配置
+        region: 画布区域 (x0, y0, x1, y1)
+        resample: 节点级重采样滤波器
+    
+    Returns:
+        tuple: (区域内的图层部分, 相对region左上角的位置(x, y))，与区域不相交时返回None
+    """
+    size, pos, matrix = layer_geometry(source.size, config)
+    rx0, ry0, rx1, ry1 = region
+    boxes = compositing.clip_box((rx1 - rx0, ry1 - ry0), (pos[0] - rx0, pos[1] - ry0), size)
+    if boxes is None:
+        return None
+    
+    (x0, y0, _, _), (lx0, ly0, lx1, ly1) = boxes
+    part_size = (lx1 - lx0, ly1 - ly0)
+    resample_filter = RESAMPLE_FILTERS[layer_resample(config, resample)]
+    
+    if matrix is None:
+        if size == source.size:
+            part = source.crop((lx0, ly0, lx1, ly1))
+        else:
+            kx, ky = source.width / size[0], source.height / size[1]
+            part = source.resize(part_size, resample_filter,
+                                 box=(lx0 * kx, ly0 * ky, lx1 * kx, ly1 * ky))
+    else:
+        if resample_filter == Image.Resampling.LANCZOS:
+            resample_filter = Image.Resampling.BICUBIC
+        a, b, c, d, e, f = matrix
+        matrix = (a, b, c + a * lx0 + b * ly0, d, e, f + d * lx0 + e * ly0)
+        part = source.transform(part_size, Image.Transform.AFFINE, matrix,
+                                resample=resample_filter, fillcolor=(0, 0, 0, 0))
+    
+    return part, (x0, y0)
+
+
+def iter_layers(images_config):
+    """按层级顺序遍历叠加图层配置
     
+    Args:
+        images_config: 图片配置列表
+    
+    Yields:
+        tuple: (叠加图片索引, 图层配置)，索引由source字段"input_N"映射得到
+    """
     # 按层级排序
     sorted_configs = sorted(enumerate(images_config), 
                            key=lambda x: x[1].get("layer", x[0]))
@@ -165,6 +359,220 @@ def composite_images(canvas, overlay_images, images_config):
         except:
             img_index = idx
         
+        yield img_index, img_config
+
+
+def _is_off_canvas(image, config, canvas_size):
+    """根据变换后的包围盒判断图层是否完全位于画布之外"""
+    size, pos, _ = layer_geometry(image_size(image), config)
+    return compositing.clip_box(canvas_size, pos, size) is None
+
+
+def _canvas_to_buffer(canvas):
+    """将画布转换为可原地修改的uint8 RGBA缓冲区"""
+    if canvas.mode != 'RGBA':
+        canvas = canvas.convert('RGBA')
+    return np.array(canvas)
+
+
+def _composite_layer(buffer, layer, pos, blend_mode="normal", opacity=1.0, workers=1,
+                     band_rows=compositing.BAND_ROWS):
+    """将变换后的图层合成到画布缓冲区
+    
+    Args:
+        buffer: uint8画布缓冲区 [H, W, 4]
+        layer: 变换后的PIL.Image或uint8 RGBA数组 [h, w, 4]
+        pos: 图层左上角位置 (x, y)
+        blend_mode: 混合模式（见 blend_modes.BLEND_MODES，未知模式按normal处理）
+        opacity: 图层透明度 (0-1)，在合成时乘到alpha上
+        workers: 分带并行合成的线程数，1表示串行
+        band_rows: 每个条带的行数，0表示不分带
+    
+    Returns:
+        合成后的画布缓冲区
+    """
+    if isinstance(layer, Image.Image) and layer.mode != 'RGBA':
+        layer = layer.convert('RGBA')
+    
+    # 只合成图层包围盒与画布的交集，完全在画布外的图层直接跳过
+    boxes = compositing.clip_box((buffer.shape[1], buffer.shape[0]), pos, image_size(layer))
+    if boxes is None:
+        return buffer
+    
+    (x0, y0, x1, y1), (sx0, sy0, sx1, sy1) = boxes
+    if isinstance(layer, Image.Image):
+        if (sx0, sy0, sx1, sy1) != (0, 0) + layer.size:
+            layer = layer.crop((sx0, sy0, sx1, sy1))
+        src = np.asarray(layer)
+    else:
+        src = layer[sy0:sy1, sx0:sx1]
+    compositing.composite_region(buffer[y0:y1, x0:x1], src, opacity, blend_mode, workers, band_rows)
+    
+    return buffer
+
+
+def image_size(image):
+    """获取PIL图片、IMAGE张量或uint8数组的尺寸 (width, height)"""
+    if isinstance(image, Image.Image):
+        return image.size
+    return (image.shape[-2], image.shape[-3])
+
+
+def _sample_slices(shape, samples):
+    """为每一维选择采样步长，使采样元素总数约为 samples
+
+    从最短的维度开始分配：批次、通道等短维度全部采样，剩余的份额留给高和宽。
+    """
+    steps = [1] * len(shape)
+    remaining = samples
+    order = sorted(range(len(shape)), key=lambda dim: shape[dim])
+    for dims_left, dim in zip(range(len(shape), 0, -1), order):
+        count = min(shape[dim], max(round(remaining ** (1 / dims_left)), 1))
+        remaining = max(remaining // count, 1)
+        steps[dim] = max(shape[dim] // count, 1)
+    return tuple(slice(None, None, step) for step in steps)
+
+
+def tensor_fingerprint(tensor, samples=4096):
+    """计算张量的廉价内容指纹
+    
+    由形状、类型、设备、存储地址、版本号以及等间隔采样的元素组成，
+    无需读取整个张量。
+    
+    Args:
+        tensor: torch.Tensor
+        samples: 采样元素数量
+    
+    Returns:
+        指纹字符串
+    """
+    data = tensor.detach()
+    if data.is_contiguous():
+        flat = data.view(-1)
+        step = max(flat.numel() // samples, 1)
+        sample = flat[::step][:samples]
+    else:
+        # 非连续张量（permute或切片得到的视图）展平会复制整个张量，改为在每一维上按步长取样
+        sample = data[_sample_slices(data.shape, samples)].reshape(-1)
+    sample = sample.cpu().numpy()
+    
+    m = hashlib.blake2b(digest_size=16)
+    m.update(repr((tuple(tensor.shape), str(tensor.dtype), str(tensor.device),
+                   tensor.data_ptr(), tensor._version)).encode())
+    m.update(sample.tobytes())
+    return m.hexdigest()
+
+
+def transform_key(config, resample="lanczos"):
+    """图层变换参数组成的缓存键
+    
+    不含平移和透明度：移动未旋转图层或调整透明度仍可命中缓存。
+    """
+    size = config.get("size", None) or {}
+    rotation = config.get("rotation", 0)
+    position = config.get("position", {"x": 0, "y": 0})
+    return (size.get("width"), size.get("height"), rotation,
+            layer_resample(config, resample),
+            # 旋转图层的像素对齐取决于位置
+            (position["x"], position["y"]) if rotation != 0 else None)
+
+
+def cached_layer_position(image, config, pos):
+    """缓存命中时的图层位置
+    
+    未旋转图层的缓存键不含平移，位置需要按当前配置重新计算；
+    旋转图层的缓存键包含位置，直接使用缓存的位置。
+    """
+    if config.get("rotation", 0) == 0:
+        return layer_geometry(image_size(image), config)[1]
+    return pos
+
+
+def prepare_layer(image, config, resample="lanczos", cache=None):
+    """变换单个叠加图层，可使用缓存
+    
+    Args:
+        image: PIL.Image或ComfyUI的IMAGE张量（张量只在缓存未命中时才转换为PIL）
+        config: 图层配置
+        resample: 默认重采样滤波器
+        cache: LRUCache，None表示不使用缓存
+    
+    Returns:
+        tuple: (uint8 RGBA数组 [h, w, 4], 位置(x, y))
+    """
+    key = None
+    if cache is not None and isinstance(image, torch.Tensor):
+        key = (tensor_fingerprint(image), transform_key(config, resample))
+        cached = cache.get(key, owner=image)
+        if cached is not None:
+            return cached[0], cached_layer_position(image, config, cached[1])
+    
+    img = tensor_to_pil(image) if isinstance(image, torch.Tensor) else image
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    
+    transformed_img, pos = apply_transform(img, config, resample)
+    layer = np.asarray(transformed_img)
+    
+    if key is not None:
+        cache.put(key, (layer, pos), layer.nbytes, owner=image)
+    
+    return layer, pos
+
+
+def resolve_workers(workers):
+    """节点的线程数参数：0表示 DEFAULT_LAYER_WORKERS"""
+    return workers if workers > 0 else DEFAULT_LAYER_WORKERS
+
+
+def map_layers(func, jobs, workers=0):
+    """在有界线程池中并行准备图层，按jobs的顺序逐个返回结果
+    
+    Pillow的缩放、旋转和格式转换会释放GIL，多个图层可以同时在多个核心上准备；
+    结果仍按输入顺序产出，调用方按层级顺序合成，输出与串行完全一致。
+    
+    Args:
+        func: 图层准备函数
+        jobs: 参数元组列表
+        workers: 线程数，0表示 DEFAULT_LAYER_WORKERS，1表示串行
+    
+    Yields:
+        func(*job) 的结果
+    """
+    workers = min(resolve_workers(workers), len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            yield func(*job)
+        return
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ImageCompositorLayer") as executor:
+        yield from executor.map(lambda job: func(*job), jobs)
+
+
+def composite_images(canvas, overlay_images, images_config, resample="lanczos", cache=None, workers=0,
+                     band_rows=compositing.BAND_ROWS):
+    """将多张图片合成到画布上
+    
+    Args:
+        canvas: PIL.Image画布
+        overlay_images: 叠加图片列表（PIL.Image或IMAGE张量）
+        images_config: 图片配置列表
+        resample: 默认重采样滤波器
+        cache: 变换后图层的LRUCache，None表示不使用缓存
+        workers: 并行准备图层和分带合成的线程数，0表示默认值，1表示串行
+        band_rows: 分带并行合成的条带行数，0表示不分带
+    
+    Returns:
+        合成后的PIL.Image
+    """
+    if not overlay_images or not images_config:
+        return canvas
+    
+    # 画布转为uint8缓冲区，各图层只在自身包围盒内合成
+    buffer = _canvas_to_buffer(canvas)
+    
+    jobs = []
+    for img_index, img_config in iter_layers(images_config):
         if 0 <= img_index < len(overlay_images):
             img = overlay_images[img_index]
             
@@ -172,36 +580,465 @@ def composite_images(canvas, overlay_images, images_config):
             if img is None:
                 continue
             
-            # 应用变换
-            transformed_img, pos = apply_transform(img, img_config)
+            # 完全位于画布外的图层无需变换和合成
+            if _is_off_canvas(img, img_config, canvas.size):
+                continue
             
-            # 混合模式
-            blend_mode = img_config.get("blendMode", "normal")
+            jobs.append((img, img_config, resample, cache))
+    
+    # 并行应用变换（未变化的图层直接取缓存），按层级顺序合成
+    for (_, img_config, _, _), (layer, pos) in zip(jobs, map_layers(prepare_layer, jobs, workers)):
+        # 混合模式
+        blend_mode = img_config.get("blendMode", "normal")
+        opacity = img_config.get("opacity", 1.0)
+        
+        buffer = _composite_layer(buffer, layer, pos, blend_mode, opacity, resolve_workers(workers), band_rows)
+    
+    return Image.fromarray(buffer, "RGBA")
+
+
+def _background_region(background, region):
+    """底图在画布区域 region 内的uint8 RGBA缓冲区
+    
+    与整幅合成一致：以底图自身alpha为蒙版粘贴到透明画布，没有底图时为全透明。
+    """
+    x0, y0, x1, y1 = region
+    if background is None:
+        return np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+    
+    bg_img = tensor_to_pil(background[..., y0:y1, x0:x1, :])
+    if bg_img.mode != 'RGBA':
+        bg_img = bg_img.convert('RGBA')
+    canvas = create_canvas(x1 - x0, y1 - y0, "transparent")
+    canvas.paste(bg_img, (0, 0), bg_img)
+    return np.array(canvas)
+
+
+def _layer_items(overlay_images, images_config, drawing, canvas_size, resample):
+    """按合成顺序列出影响画布的图层，用于比较两次布局
+    
+    Returns:
+        list: [(比较键, 画布上的包围盒(x0, y0, x1, y1), 输入对象, 合成参数)]，
+        合成参数为 (图片, 配置) 或绘画层 (图像, 位置)
+    """
+    items = []
+    for img_index, img_config in iter_layers(images_config):
+        if not 0 <= img_index < len(overlay_images) or overlay_images[img_index] is None:
+            continue
+        img = overlay_images[img_index]
+        size, pos, _ = layer_geometry(image_size(img), img_config)
+        boxes = compositing.clip_box(canvas_size, pos, size)
+        if boxes is None:
+            continue
+        key = ("layer", img_index, tensor_fingerprint(img) if isinstance(img, torch.Tensor) else id(img),
+               json.dumps(img_config, sort_keys=True), layer_resample(img_config, resample))
+        items.append((key, boxes[0], img, (img, img_config)))
+    
+    if drawing is not None:
+        drawing_img, offset = drawing
+        boxes = compositing.clip_box(canvas_size, offset, drawing_img.size)
+        if boxes is not None:
+            items.append((("drawing", offset, drawing_img.size), boxes[0], drawing_img, drawing))
+    
+    return items
+
+
+def _dirty_regions(old_items, new_items):
+    """比较两次布局，返回需要重绘的画布区域列表
+    
+    去掉两次布局相同的前缀和后缀后，中间有变化的图层（包括增删和调整顺序）
+    新旧包围盒以外的像素，合成顺序上覆盖它们的图层序列不变。
+    """
+    def same(old, new):
+        return old[0] == new[0] and old[2]() is new[2]
+    
+    start = 0
+    while start < min(len(old_items), len(new_items)) and same(old_items[start], new_items[start]):
+        start += 1
+    end = 0
+    while (end < min(len(old_items), len(new_items)) - start
+           and same(old_items[-1 - end], new_items[-1 - end])):
+        end += 1
+    
+    regions = []
+    for item in old_items[start:len(old_items) - end] + new_items[start:len(new_items) - end]:
+        if item[1] not in regions:
+            regions.append(item[1])
+    return regions
+
+
+def _intersects(box, region):
+    """两个 (x0, y0, x1, y1) 矩形是否相交"""
+    return box[0] < region[2] and region[0] < box[2] and box[1] < region[3] and region[1] < box[3]
+
+
+def _render_region(buffer, region, background, items, prepared, workers=1, band_rows=compositing.BAND_ROWS):
+    """从底图开始重新合成画布缓冲区的一个区域（原地修改buffer）
+    
+    Args:
+        prepared: {图层在items中的序号: (变换后的图层, 位置)}
+        workers: 分带并行合成的线程数
+        band_rows: 每个条带的行数
+    """
+    x0, y0, x1, y1 = region
+    view = buffer[y0:y1, x0:x1]
+    view[...] = _background_region(background, region)
+    
+    for index, (_, box, _, params) in enumerate(items):
+        if not _intersects(box, region):
+            continue
+        if isinstance(params[1], dict):
+            img_config = params[1]
+            layer, pos = prepared[index]
+            _composite_layer(view, layer, (pos[0] - x0, pos[1] - y0),
+                             img_config.get("blendMode", "normal"), img_config.get("opacity", 1.0),
+                             workers, band_rows)
+        else:
+            drawing_img, (dx, dy) = params
+            _composite_layer(view, drawing_img, (dx - x0, dy - y0), workers=workers, band_rows=band_rows)
+
+
+def composite_incremental(state_key, background, overlay_images, images_config, drawing=None,
+                          resample="lanczos", cache=None, canvas_size=(1024, 1024), workers=0,
+                          band_rows=compositing.BAND_ROWS):
+    """增量合成：只重绘与上一次合成相比发生变化的区域
+    
+    每个 state_key（节点的unique_id）在 render_cache 中保存上一次的布局和画布，
+    再次运行时只重绘有变化的图层新旧包围盒，其余像素直接复用。底图、画布尺寸
+    或滤波器变化时整幅重绘。输入张量按对象身份比较，上游重新执行后视为变化。
+    结果与 composite_images 加绘画层的整幅合成完全一致。
+    
+    Args:
+        state_key: 状态键（节点的unique_id）
+        background: 底图IMAGE张量或None
+        overlay_images: 叠加图片列表（IMAGE张量或None）
+        images_config: 叠加图层配置列表
+        drawing: 绘画层 (RGBA图像, 位置) 或None
+        resample: 默认重采样滤波器
+        cache: 变换后图层的LRUCache，None表示不使用缓存
+        canvas_size: 没有底图时的画布尺寸 (width, height)
+        workers: 并行准备图层和分带合成的线程数，0表示默认值，1表示串行
+        band_rows: 分带并行合成的条带行数，0表示不分带
+    
+    Returns:
+        合成后的uint8 RGBA缓冲区 [H, W, 4]（缓存持有，调用方只读）
+    """
+    if background is not None:
+        canvas_size = image_size(background)
+    width, height = canvas_size
+    
+    base = (tuple(canvas_size), resample,
+            tensor_fingerprint(background) if background is not None else None)
+    items = _layer_items(overlay_images, images_config, drawing, canvas_size, resample)
+    
+    state = render_cache.get(state_key)
+    if (state is not None and state["base"] == base
+            and (background is None or state["background"]() is background)):
+        buffer = state["buffer"]
+        regions = _dirty_regions(state["items"], items)
+    else:
+        buffer = np.empty((height, width, 4), dtype=np.uint8)
+        regions = [(0, 0, width, height)]
+    
+    # 只准备与重绘区域相交的图层
+    indices = [index for index, (_, box, _, params) in enumerate(items)
+               if isinstance(params[1], dict) and any(_intersects(box, region) for region in regions)]
+    jobs = [items[index][3] + (resample, cache) for index in indices]
+    prepared = dict(zip(indices, map_layers(prepare_layer, jobs, workers)))
+    
+    for region in regions:
+        _render_region(buffer, region, background, items, prepared, resolve_workers(workers), band_rows)
+    
+    # 只保存比较所需的键、包围盒和输入的弱引用，不持有输入张量
+    render_cache.put(state_key, {
+        "base": base,
+        "background": weakref.ref(background) if background is not None else None,
+        "items": [(key, box, weakref.ref(obj), None) for key, box, obj, _ in items],
+        "buffer": buffer,
+    }, buffer.nbytes)
+    
+    return buffer
+
+
+def composite_tiles(background, overlay_images, images_config, drawing=None, tile_size=2048,
+                    resample="lanczos", canvas_size=(1024, 1024), workers=0, band_rows=compositing.BAND_ROWS,
+                    rgb_only=False):
+    """分块合成到预分配的输出张量
+    
+    画布按 tile_size 分块逐块合成，每块只渲染与之相交的图层部分，
+    工作内存与分块大小和相交图层数成正比，与画布尺寸无关。
+    未缩放和旋转的图层与 composite_images 整幅合成的结果完全一致；缩放图层
+    按分块区域重采样，滤波系数的浮点舍入可能带来 2/255 以内的误差。
+    
+    Args:
+        background: 底图IMAGE张量或None
+        overlay_images: 叠加图片列表（IMAGE张量或None）
+        images_config: 叠加图层配置列表
+        drawing: 绘画层 (RGBA图像, 位置) 或None
+        tile_size: 分块边长（像素）
+        resample: 默认重采样滤波器
+        canvas_size: 没有底图时的画布尺寸 (width, height)
+        workers: 并行准备图层源图和分带合成的线程数，0表示默认值，1表示串行
+        band_rows: 分带并行合成的条带行数，0表示不分带
+        rgb_only: 只输出RGB图像（见 allocate_output）
+    
+    Returns:
+        tuple: ([1, H, W, 4或3] 图像张量, [1, H, W] 蒙版)
+    """
+    width, height = image_size(background) if background is not None else canvas_size
+    result, mask = allocate_output(1, height, width, rgb_only)
+    
+    # 源图只并行准备一次，完全在画布外的图层直接跳过
+    jobs = []
+    for img_index, img_config in iter_layers(images_config):
+        if not 0 <= img_index < len(overlay_images) or overlay_images[img_index] is None:
+            continue
+        if _is_off_canvas(overlay_images[img_index], img_config, (width, height)):
+            continue
+        jobs.append((overlay_images[img_index], img_config))
+    layers = [(source, job[1]) for job, source in zip(jobs, map_layers(layer_source, jobs, workers))]
+    
+    for ty0 in range(0, height, tile_size):
+        for tx0 in range(0, width, tile_size):
+            ty1 = min(ty0 + tile_size, height)
+            tx1 = min(tx0 + tile_size, width)
+            
+            buffer = _background_region(background, (tx0, ty0, tx1, ty1))
             
-            if blend_mode == "normal":
-                # 使用alpha_composite来正确处理透明度
-                temp = Image.new('RGBA', canvas.size, (0, 0, 0, 0))
-                # 确保图像是RGBA格式以便正确合成
-                if transformed_img.mode == 'RGBA':
-                    temp.paste(transformed_img, pos)
-                else:
-                    # 如果不是RGBA，需要转换
-                    transformed_img_rgba = transformed_img.convert('RGBA')
-                    temp.paste(transformed_img_rgba, pos)
-                canvas = Image.alpha_composite(canvas, temp)
-            else:
-                # 简单的混合模式支持
-                temp = Image.new('RGBA', canvas.size, (0, 0, 0, 0))
-                temp.paste(transformed_img, pos)
-                
-                if blend_mode == "multiply":
-                    canvas = Image.blend(canvas, temp, 0.5)
-                elif blend_mode == "screen":
-                    canvas = Image.blend(canvas, temp, 0.7)
-                else:
-                    canvas = Image.alpha_composite(canvas, temp)
+            for source, img_config in layers:
+                part = transform_region(source, img_config, (tx0, ty0, tx1, ty1), resample)
+                if part is None:
+                    continue
+                _composite_layer(buffer, part[0], part[1], img_config.get("blendMode", "normal"),
+                                 img_config.get("opacity", 1.0), resolve_workers(workers), band_rows)
+            
+            if drawing is not None:
+                drawing_img, (dx, dy) = drawing
+                _composite_layer(buffer, drawing_img, (dx - tx0, dy - ty0), workers=resolve_workers(workers),
+                                 band_rows=band_rows)
+            
+            # 分块直接写入预分配的输出
+            write_output(buffer, result, mask, origin=(tx0, ty0))
     
-    return canvas
+    return result, mask
+
+
+def allocate_output(batch, height, width, rgb_only=False):
+    """预分配ComfyUI的IMAGE和MASK输出
+    
+    蒙版是图像alpha通道的视图，不单独占用内存；rgb_only 时图像只有RGB三个通道，
+    蒙版单独分配。
+    
+    Args:
+        batch: 帧数
+        height: 高度
+        width: 宽度
+        rgb_only: 只输出RGB图像
+    
+    Returns:
+        tuple: ([B, H, W, 4或3] 图像张量, [B, H, W] 蒙版)
+    """
+    image = torch.empty((batch, height, width, 3 if rgb_only else 4), dtype=torch.float32)
+    if rgb_only:
+        return image, torch.empty((batch, height, width), dtype=torch.float32)
+    return image, image[..., 3]
+
+
+def write_output(canvas, image, mask, index=0, origin=(0, 0)):
+    """将uint8 RGBA画布一次缩放写入预分配的输出（见 allocate_output）
+    
+    直接从画布的uint8视图转换并除以255写入目标位置，不产生整幅的中间数组，
+    结果与 pil_to_tensor / extract_mask 逐位一致。
+    
+    Args:
+        canvas: RGBA模式的PIL.Image或uint8数组 [h, w, 4]
+        image: 预分配的图像张量
+        mask: 预分配的蒙版张量
+        index: 写入的帧序号
+        origin: 写入位置的左上角 (x, y)，分块输出时使用
+    """
+    buffer = canvas if isinstance(canvas, np.ndarray) else np.array(canvas)
+    x, y = origin
+    h, w = buffer.shape[:2]
+    
+    frame = image[index, y:y + h, x:x + w]
+    frame.copy_(torch.from_numpy(buffer[..., :frame.shape[-1]])).div_(255.0)
+    if image.shape[-1] == 3:
+        mask[index, y:y + h, x:x + w].copy_(torch.from_numpy(buffer[..., 3])).div_(255.0)
+
+
+def canvas_to_output(canvas, rgb_only=False):
+    """将合成后的RGBA画布转换为ComfyUI的IMAGE和MASK输出
+    
+    Args:
+        canvas: RGBA模式的PIL.Image或uint8数组 [H, W, 4]
+        rgb_only: 只输出RGB图像
+    
+    Returns:
+        tuple: ([1, H, W, 4或3] 图像张量, [1, H, W] 蒙版)
+    """
+    width, height = image_size(canvas)
+    image, mask = allocate_output(1, height, width, rgb_only)
+    write_output(canvas, image, mask)
+    return image, mask
+
+
+def draft_box(canvas_size, crop):
+    """计算草稿模式的裁剪区域
+    
+    Args:
+        canvas_size: 画布尺寸 (width, height)
+        crop: (x, y, width, height)，以底图（画布）像素为单位，宽高为0表示到画布边缘
+    
+    Returns:
+        裁剪到画布内的区域 (x0, y0, x1, y1)
+    """
+    x, y, w, h = crop
+    width, height = canvas_size
+    x1 = width if w <= 0 else x + w
+    y1 = height if h <= 0 else y + h
+    box = (max(x, 0), max(y, 0), min(x1, width), min(y1, height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        raise ValueError(f"[ImageCompositor] 裁剪区域 {tuple(crop)} 不在画布 {width}x{height} 内")
+    return box
+
+
+def draft_size(size, scale):
+    """按输出比例缩放后的尺寸 (width, height)，至少1像素"""
+    return (max(round(size[0] * scale), 1), max(round(size[1] * scale), 1))
+
+
+def draft_image(image, scale, box=None, cache=None):
+    """生成草稿模式使用的低分辨率代理图
+    
+    先裁剪再用面积平均缩小一次（带透明通道时在预乘空间缩放），之后所有路径都以
+    代理图为输入。尺寸不变（比例为1）时直接返回裁剪视图，不复制也不重采样。
+    结果以原张量为所有者缓存，同一输入重复运行时返回同一个对象，
+    图层缓存和增量重绘仍可命中。
+    
+    Args:
+        image: [B, H, W, C] IMAGE张量
+        scale: 输出比例 (0-1]
+        box: 裁剪区域 (x0, y0, x1, y1)，None表示整幅图
+        cache: LRUCache，None表示不使用缓存
+    
+    Returns:
+        [B, h, w, C] 浮点张量
+    """
+    key = None
+    if cache is not None:
+        key = ("draft", tensor_fingerprint(image), scale, box)
+        cached = cache.get(key, owner=image)
+        if cached is not None:
+            return cached
+    
+    src = image if image.dim() == 4 else image.unsqueeze(0)
+    if box is not None:
+        x0, y0, x1, y1 = box
+        src = src[:, y0:y1, x0:x1]
+    
+    width, height = draft_size((src.shape[2], src.shape[1]), scale)
+    if (width, height) == (src.shape[2], src.shape[1]) and src.dtype == torch.float32:
+        # 裁剪视图与原张量共用存储，不计入缓存预算
+        if key is not None:
+            cache.put(key, src, 0, owner=image)
+        return src
+    
+    bchw = src.float().permute(0, 3, 1, 2)
+    if (width, height) != (src.shape[2], src.shape[1]):
+        if bchw.shape[1] == 4:
+            # 预乘后缩放，避免透明边缘出现色边
+            alpha = bchw[:, 3:]
+            bchw = F.interpolate(torch.cat([bchw[:, :3] * alpha, alpha], dim=1),
+                                 size=(height, width), mode="area")
+            alpha = bchw[:, 3:]
+            rgb = (bchw[:, :3] / alpha.clamp(min=1e-8)).masked_fill_(alpha <= 0, 0.0).clamp_(0.0, 1.0)
+            bchw = torch.cat([rgb, alpha], dim=1)
+        else:
+            bchw = F.interpolate(bchw, size=(height, width), mode="area")
+    result = bchw.permute(0, 2, 3, 1).contiguous()
+    
+    if key is not None:
+        cache.put(key, result, result.numel() * result.element_size(), owner=image)
+    return result
+
+
+def draft_canvas(size, cache=None):
+    """草稿模式下没有底图时使用的全透明底图张量 [1, h, w, 4]
+    
+    缓存后同一尺寸返回同一个对象，增量重绘可以复用上一次的画布。
+    """
+    width, height = size
+    key = ("draft-canvas", width, height)
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        return cached
+    
+    blank = torch.zeros((1, height, width, 4), dtype=torch.float32)
+    if cache is not None:
+        cache.put(key, blank, blank.numel() * blank.element_size())
+    return blank
+
+
+def draft_config(config, scale, origin=(0, 0)):
+    """将图层配置换算到草稿画布坐标
+    
+    位置减去裁剪区域左上角后按比例缩放，显式尺寸同样缩放；没有尺寸的图层
+    使用已缩小的代理图的原始尺寸。旋转角度不变。
+    
+    Args:
+        config: 图层配置
+        scale: 输出比例
+        origin: 裁剪区域左上角 (x, y)
+    
+    Returns:
+        新的配置字典（不修改原配置）
+    """
+    config = dict(config)
+    position = config.get("position", {"x": 0, "y": 0})
+    config["position"] = {"x": (position["x"] - origin[0]) * scale,
+                          "y": (position["y"] - origin[1]) * scale}
+    size = config.get("size", None)
+    if size:
+        config["size"] = {key: value * scale for key, value in size.items() if key in ("width", "height")}
+    return config
+
+
+def draft_drawing(drawing, scale, box, cache=None):
+    """将整幅分辨率的绘画层裁剪并缩小到草稿画布
+    
+    Args:
+        drawing: (RGBA图像, 位置) 或None
+        scale: 输出比例
+        box: 裁剪区域 (x0, y0, x1, y1)
+        cache: LRUCache，None表示不使用缓存
+    
+    Returns:
+        草稿画布上的 (RGBA图像, 位置)，与裁剪区域不相交时返回None
+    """
+    if drawing is None:
+        return None
+    
+    img, (ox, oy) = drawing
+    key = ("draft", id(img), scale, box)
+    cached = cache.get(key, owner=img) if cache is not None else None
+    if cached is not None:
+        return cached if cached[0] is not None else None
+    
+    x0, y0, x1, y1 = box
+    crop = (max(x0 - ox, 0), max(y0 - oy, 0), min(x1 - ox, img.width), min(y1 - oy, img.height))
+    entry = (None, None)
+    if crop[0] < crop[2] and crop[1] < crop[3]:
+        region = img.crop(crop)
+        size = draft_size(region.size, scale)
+        if size != region.size:
+            region = region.resize(size, Image.Resampling.BOX)
+        entry = (region, (round((ox + crop[0] - x0) * scale), round((oy + crop[1] - y0) * scale)))
+    
+    if cache is not None:
+        nbytes = entry[0].width * entry[0].height * 4 if entry[0] is not None else 0
+        cache.put(key, entry, nbytes, owner=img)
+    return entry if entry[0] is not None else None
 
 
 def save_temp_image(pil_image, prefix="temp"):
@@ -228,13 +1065,14 @@ def save_temp_image(pil_image, prefix="temp"):
     return filename
 
 
-def composite_images_v2(canvas, all_images, images_config):
+def composite_images_v2(canvas, all_images, images_config, resample="lanczos"):
     """将多张图片合成到画布上（背景图也作为图层处理）
     
     Args:
         canvas: PIL.Image画布
         all_images: 所有图片列表（第一个是背景图，如果有的话）
         images_config: 图片配置列表
+        resample: 默认重采样滤波器
     
     Returns:
         合成后的PIL.Image
@@ -272,6 +1110,8 @@ def composite_images_v2(canvas, all_images, images_config):
             "layer": idx
         })
     
+    buffer = _canvas_to_buffer(canvas)
+    
     # 按层级排序（保持稳定排序）
     sorted_indices = sorted(range(len(images_config)), 
                            key=lambda i: (images_config[i].get("layer", i), i))
@@ -281,36 +1121,20 @@ def composite_images_v2(canvas, all_images, images_config):
             img = all_images[idx]
             img_config = images_config[idx]
             
+            # 完全位于画布外的图层无需变换和合成
+            if _is_off_canvas(img, img_config, canvas.size):
+                continue
+            
             # 应用变换
-            transformed_img, pos = apply_transform(img, img_config)
+            transformed_img, pos = apply_transform(img, img_config, resample)
             
             # 混合模式
             blend_mode = img_config.get("blendMode", "normal")
+            opacity = img_config.get("opacity", 1.0)
             
-            if blend_mode == "normal":
-                # 使用alpha_composite来正确处理透明度
-                temp = Image.new('RGBA', canvas.size, (0, 0, 0, 0))
-                # 确保图像是RGBA格式以便正确合成
-                if transformed_img.mode == 'RGBA':
-                    temp.paste(transformed_img, pos)
-                else:
-                    # 如果不是RGBA，需要转换
-                    transformed_img_rgba = transformed_img.convert('RGBA')
-                    temp.paste(transformed_img_rgba, pos)
-                canvas = Image.alpha_composite(canvas, temp)
-            else:
-                # 简单的混合模式支持
-                temp = Image.new('RGBA', canvas.size, (0, 0, 0, 0))
-                temp.paste(transformed_img, pos)
-                
-                if blend_mode == "multiply":
-                    canvas = Image.blend(canvas, temp, 0.5)
-                elif blend_mode == "screen":
-                    canvas = Image.blend(canvas, temp, 0.7)
-                else:
-                    canvas = Image.alpha_composite(canvas, temp)
+            buffer = _composite_layer(buffer, transformed_img, pos, blend_mode, opacity)
     
-    return canvas
+    return Image.fromarray(buffer, "RGBA")
 
 
 def extract_mask(image):
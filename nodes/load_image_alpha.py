@@ -3,12 +3,58 @@
 专门用于加载和保持PNG图像的透明通道
 """
 import os
+import threading
 import torch
 import numpy as np
-import hashlib
-from PIL import Image, ImageOps, ImageSequence
+from PIL import Image, ImageOps
 import folder_paths
 import node_helpers
+from . import fingerprint
+from .cache import LRUCache
+
+
+# EXIF方向标记
+EXIF_ORIENTATION = 0x0112
+
+# 按16位范围归一化的单通道整数模式
+SIXTEEN_BIT_MODES = ("I", "I;16", "I;16L", "I;16B", "I;16N")
+
+# 解码后图像的进程内缓存（默认1024MB，节点可调整预算）
+image_cache = LRUCache("decoded_images", 1024 * 1024 * 1024)
+
+# 输入目录列表缓存：目录 -> (目录mtime_ns, 图片文件列表)
+_listing_cache = {}
+# 文件名 -> 是否为图片（内容类型过滤结果）
+_content_type_cache = {}
+_listing_lock = threading.Lock()
+
+
+def list_input_images(input_dir):
+    """列出输入目录中的图片文件（已排序）
+
+    目录的mtime在增删或重命名文件时才会变化，未变化时直接返回缓存的列表；
+    内容类型过滤结果按文件名记忆，目录变化后只需判断新出现的文件。
+    """
+    mtime_ns = os.stat(input_dir).st_mtime_ns
+    with _listing_lock:
+        cached = _listing_cache.get(input_dir)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+    # scandir的is_file()通常可以直接使用目录项类型，无需逐个stat
+    with os.scandir(input_dir) as it:
+        files = [entry.name for entry in it if entry.is_file()]
+
+    with _listing_lock:
+        unknown = [f for f in files if f not in _content_type_cache]
+        if unknown:
+            images = set(folder_paths.filter_files_content_types(unknown, ["image"]))
+            for f in unknown:
+                _content_type_cache[f] = f in images
+
+        result = sorted(f for f in files if _content_type_cache[f])
+        _listing_cache[input_dir] = (mtime_ns, result)
+    return result
 
 
 class LoadImageAlpha:
@@ -19,12 +65,47 @@ class LoadImageAlpha:
     
     @classmethod
     def INPUT_TYPES(s):
-        input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
-        files = folder_paths.filter_files_content_types(files, ["image"])
+        files = list_input_images(folder_paths.get_input_directory())
         return {
             "required": {
-                "image": (sorted(files), {"image_upload": True})
+                "image": (list(files), {"image_upload": True})
+            },
+            "optional": {
+                "frame_start": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 100000,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "frame_count": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 100000,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "frame_stride": ("INT", {
+                    "default": 1,
+                    "min": 1,
+                    "max": 1000,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "downscale": ("INT", {
+                    "default": 1,
+                    "min": 1,
+                    "max": 16,
+                    "step": 1,
+                    "display": "number"
+                }),
+                "cache_size_mb": ("INT", {
+                    "default": 1024,
+                    "min": 0,
+                    "max": 65536,
+                    "step": 64,
+                    "display": "number"
+                }),
             },
         }
 
@@ -33,70 +114,147 @@ class LoadImageAlpha:
     RETURN_NAMES = ("IMAGE",)
     FUNCTION = "load_image"
 
-    def load_image(self, image):
+    def load_image(self, image, frame_start=0, frame_count=0, frame_stride=1, downscale=1, cache_size_mb=1024):
         """
         加载图像并保持透明通道
+        
+        动图只解码 frame_start 起每隔 frame_stride 帧、共 frame_count 帧（0表示到最后一帧），
+        downscale 大于1时在解码阶段按整数倍缩小。
         """
         image_path = folder_paths.get_annotated_filepath(image)
         
+        # 按文件内容指纹缓存解码结果，预算为0时禁用
+        image_cache.set_budget(cache_size_mb * 1024 * 1024)
+        key = None
+        if cache_size_mb > 0:
+            key = (fingerprint.file_fingerprint(image_path), frame_start, frame_count, frame_stride, downscale)
+        output_image = image_cache.get(key) if key is not None else None
+        
+        if output_image is None:
+            output_image = self._decode_image(image_path, frame_start, frame_count, frame_stride, downscale)
+            if key is not None:
+                image_cache.put(key, output_image, output_image.numel() * output_image.element_size())
+        
+        return (output_image,)
+    
+    def _decode_image(self, image_path, frame_start=0, frame_count=0, frame_stride=1, downscale=1):
+        """
+        解码图像文件中选定的帧为RGBA张量 [N, H, W, 4]
+        """
         # 打开图像
         img = node_helpers.pillow(Image.open, image_path)
         
-        output_images = []
+        total_frames = getattr(img, "n_frames", 1)
+        if frame_start >= total_frames:
+            raise ValueError(f"[LoadImageAlpha] frame_start {frame_start} 超出图像帧数 {total_frames}")
+        frame_end = total_frames if frame_count <= 0 else min(total_frames, frame_start + frame_count * frame_stride)
+        frame_indices = range(frame_start, frame_end, frame_stride)
+        n_frames = len(frame_indices)
+        
+        target_size = None
+        if downscale > 1:
+            # JPEG等格式可以直接以缩小的尺寸解码（其他格式无操作）
+            target_size = (-(-img.width // downscale), -(-img.height // downscale))
+            img.draft(img.mode, target_size)
+        
+        # 输出张量在第一帧解码后一次性分配，之后每帧原地填充
+        output_image = None
+        count = 0
         w, h = None, None
         
-        for i in ImageSequence.Iterator(img):
-            # 处理EXIF方向
-            i = node_helpers.pillow(ImageOps.exif_transpose, i)
-            
-            # 处理不同的图像模式
-            if i.mode == 'I':
-                i = i.point(lambda x: x * (1 / 255))
+        # 方向标记对所有帧相同，只检查一次
+        needs_transpose = img.getexif().get(EXIF_ORIENTATION, 1) not in (None, 1)
+        
+        for index in frame_indices:
+            # 只定位并解码需要的帧
+            img.seek(index)
+            i = img
             
-            # 检查是否有透明通道
-            has_alpha = 'A' in i.getbands() or (i.mode == 'P' and 'transparency' in i.info)
+            if target_size is not None:
+                i = self._downscale(i, target_size)
             
-            if has_alpha:
-                # 保持RGBA格式
-                if i.mode != 'RGBA':
-                    image = i.convert("RGBA")
-                else:
-                    image = i
-            else:
-                # 没有透明通道，转换为RGBA（添加不透明的alpha）
-                image = i.convert("RGBA")
+            # 处理EXIF方向（没有方向标记时跳过，避免复制整帧）
+            if needs_transpose:
+                i = node_helpers.pillow(ImageOps.exif_transpose, i)
             
             # 尺寸检查
-            if len(output_images) == 0:
-                w = image.size[0]
-                h = image.size[1]
+            if output_image is None:
+                w = i.size[0]
+                h = i.size[1]
+                output_image = torch.empty((n_frames, h, w, 4), dtype=torch.float32)
+                output_array = output_image.numpy()
             
-            if image.size[0] != w or image.size[1] != h:
+            if i.size[0] != w or i.size[1] != h:
                 continue
             
-            # 转换为numpy数组（4通道）
-            np_image = np.array(image).astype(np.float32) / 255.0
-            # 转换为tensor [H, W, C]
-            tensor_image = torch.from_numpy(np_image)
-            # 添加batch维度 [1, H, W, C]
-            tensor_image = tensor_image.unsqueeze(0)
-            
-            output_images.append(tensor_image)
+            self._frame_to_array(i, output_array[count])
+            count += 1
+        
+        # 跳过了尺寸不一致的帧时只返回已填充的部分
+        return output_image[:count] if count < n_frames else output_image
+
+    def _frame_to_array(self, frame, out):
+        """
+        将一帧写入输出数组 [H, W, 4]，直接从PIL缓冲区一次完成类型转换和缩放
         
-        if len(output_images) > 1:
-            output_image = torch.cat(output_images, dim=0)
+        RGBA/RGB/L直接读取，不做convert；16位灰度（I;16、I）按65535归一化，
+        保留高位深；其他模式（P、LA、CMYK等）以及带tRNS颜色键的RGB/L转换为RGBA。
+        """
+        mode = frame.mode
+        transparency = frame.info.get('transparency')
+        if mode in SIXTEEN_BIT_MODES:
+            gray = np.asarray(frame).astype(np.float32)
+            np.clip(gray, 0, 65535, out=gray)
+            np.divide(gray[..., None], np.float32(65535), out=out[..., :3])
+            if transparency is None:
+                out[..., 3] = 1.0
+            else:
+                # PIL的convert不支持16位颜色键，直接按原始灰度值比较
+                np.not_equal(np.asarray(frame), transparency, out=out[..., 3])
+        elif mode == 'RGBA':
+            np.divide(np.asarray(frame), np.float32(255), out=out)
+        elif mode == 'RGB' and transparency is None:
+            np.divide(np.asarray(frame), np.float32(255), out=out[..., :3])
+            out[..., 3] = 1.0
+        elif mode == 'L' and transparency is None:
+            np.divide(np.asarray(frame)[..., None], np.float32(255), out=out[..., :3])
+            out[..., 3] = 1.0
         else:
-            output_image = output_images[0]
+            # 调色板透明色、tRNS颜色键、LA等统一转换为RGBA
+            np.divide(np.asarray(frame.convert("RGBA")), np.float32(255), out=out)
+    
+    def _downscale(self, frame, size):
+        """
+        将帧缩小到目标尺寸（draft已经缩小过时只处理剩余部分）
+        整数倍时使用reduce块平均，否则使用BOX缩放
+        """
+        if frame.size == size:
+            return frame
         
-        return (output_image,)
-
+        # 调色板图像和16位图像不能直接缩放；颜色键透明在缩放后无法再匹配，先转换为RGBA
+        has_key = 'transparency' in frame.info
+        if frame.mode in ('P', 'RGB', 'L') and (frame.mode == 'P' or has_key):
+            frame = frame.convert("RGBA" if has_key else "RGB")
+        elif frame.mode in SIXTEEN_BIT_MODES and has_key:
+            # 带颜色键的16位灰度按8位RGBA缩放（convert不支持16位颜色键）
+            gray = np.asarray(frame)
+            rgba = np.empty(gray.shape + (4,), dtype=np.uint8)
+            rgba[..., :3] = (np.clip(gray, 0, 65535) // 257)[..., None]
+            rgba[..., 3] = np.where(gray == frame.info['transparency'], 0, 255)
+            frame = Image.fromarray(rgba, "RGBA")
+        elif frame.mode in SIXTEEN_BIT_MODES:
+            frame = frame.convert("I")
+        
+        factor = (frame.width // size[0], frame.height // size[1])
+        if (-(-frame.width // factor[0]), -(-frame.height // factor[1])) == size:
+            return frame.reduce(factor)
+        return frame.resize(size, Image.Resampling.BOX)
+    
     @classmethod
-    def IS_CHANGED(s, image):
+    def IS_CHANGED(s, image, **kwargs):
+        # 文件未变化（大小、修改时间、inode相同）时直接返回缓存的哈希
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return fingerprint.file_fingerprint(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
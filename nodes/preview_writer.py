@@ -0,0 +1,192 @@
+"""
+预览图写入
+在后台线程池中编码并保存输入预览缩略图，文件名由像素内容哈希决定，
+相同输入重复运行时直接复用已有文件
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import folder_paths
+from PIL import Image
+from . import image_utils
+
+
+# PNG压缩级别：预览图只在本机临时目录中使用，优先保证编码速度
+PREVIEW_COMPRESS_LEVEL = 1
+
+# 不透明（RGB）预览使用的JPEG质量
+PREVIEW_JPEG_QUALITY = 90
+
+
+def _is_opaque(tensor):
+    """预览帧（第一帧）是否完全不透明：没有alpha通道，或alpha全为1"""
+    if tensor.shape[-1] != 4:
+        return True
+    frame = tensor[0] if tensor.dim() == 4 else tensor
+    return bool(frame[..., 3].min() >= 1.0)
+
+
+class PreviewWriter:
+    """
+    异步预览写入器
+
+    save() 立即返回，张量转换、内容哈希、缩放和编码都在后台线程中完成，文件名由
+    第一帧uint8像素的内容哈希决定。文件先写入临时文件再原子替换，前端不会读到
+    写了一半的图片。
+    """
+
+    def __init__(self, max_workers=min(4, os.cpu_count() or 1)):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ImageCompositorPreview")
+        self._pending = set()
+        # 文件名 -> 正在写入该文件时设置的Event
+        self._writing = {}
+        self._lock = threading.Lock()
+
+    def save(self, tensor, prefix="temp", max_edge=0):
+        """提交一张预览图
+
+        Args:
+            tensor: ComfyUI格式的图像张量 [B, H, W, C]（只保存第一帧）
+            prefix: 文件名前缀
+            max_edge: 缩略图最长边（像素），0表示保存原始分辨率
+
+        Returns:
+            Future，结果为文件名（完成时文件已写入，失败时为None）
+        """
+        future = self._executor.submit(self._save, tensor, prefix, max_edge)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def preview(self, tensor, source, max_edge=0):
+        """提交预览并返回前端使用的预览条目
+
+        Args:
+            tensor: 图像张量
+            source: 图片来源（"background" 或 "input_N"）
+            max_edge: 缩略图最长边，0表示原始分辨率
+
+        Returns:
+            dict: {"image": 文件名的Future, "type": 来源, "original_size": [原图宽, 原图高]}，
+            返回给前端前用 ready() 换成文件名
+        """
+        prefix = "bg" if source == "background" else source
+        return {
+            "image": self.save(tensor, prefix, max_edge),
+            "type": source,
+            "original_size": list(image_utils.image_size(tensor)),
+        }
+
+    def write_image(self, image, filepath, format="PNG", **params):
+        """在后台线程中保存一张已准备好的图像
+
+        Args:
+            image: PIL.Image或uint8数组
+            filepath: 目标路径
+            format: 图像格式
+            params: 传给 Image.save 的编码参数
+
+        Returns:
+            Future，完成后文件已写入
+        """
+        return self._executor.submit(self._save_atomic, image, filepath, format, **params)
+
+    def ready(self, previews):
+        """等待预览写入完成，返回前端使用的预览条目
+
+        节点返回UI输出前调用：前端收到文件名后会立即请求 /view，文件必须已经存在。
+        合成期间预览仍在后台写入，这里只等待尚未完成的部分。
+
+        Args:
+            previews: preview() 返回的预览条目列表
+
+        Returns:
+            "image" 换成文件名的预览条目列表（写入失败的条目被跳过）
+        """
+        entries = []
+        for entry in previews:
+            filename = entry["image"].result()
+            if filename is not None:
+                entries.append(dict(entry, image=filename))
+        return entries
+
+    def wait(self):
+        """等待所有已提交的预览写入完成"""
+        with self._lock:
+            futures = list(self._pending)
+        for future in futures:
+            future.result()
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _save(self, tensor, prefix, max_edge):
+        try:
+            img = image_utils.tensor_to_pil(tensor)
+            if max_edge <= 0 or max(img.size) <= max_edge:
+                max_edge = 0
+
+            # 文件名取编码所用的uint8像素的内容哈希：同名文件的内容必然相同，可以直接复用
+            digest = hashlib.blake2b(repr((img.mode, img.size)).encode(), digest_size=16)
+            digest.update(img.tobytes())
+
+            # 不透明图片（包括alpha全为1的RGBA输入）使用更快、更小的JPEG，带透明度的使用低压缩PNG
+            ext = "jpg" if _is_opaque(tensor) else "png"
+            suffix = f"_{max_edge}" if max_edge else ""
+            filename = f"{prefix}_{digest.hexdigest()}{suffix}.{ext}"
+            filepath = os.path.join(folder_paths.get_temp_directory(), filename)
+        except Exception as e:
+            print(f"[ImageCompositor] 生成预览图失败 ({prefix}): {e}")
+            return None
+
+        with self._lock:
+            writing = self._writing.get(filename)
+            owner = writing is None and not os.path.exists(filepath)
+            if owner:
+                self._writing[filename] = threading.Event()
+        if not owner:
+            if writing is not None:
+                # 同一内容正在由另一个任务写入，等它完成
+                writing.wait()
+            return filename
+
+        try:
+            self._write(img, filepath, max_edge)
+        except Exception as e:
+            print(f"[ImageCompositor] 保存预览图失败 {filename}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._writing.pop(filename).set()
+        return filename
+
+    def _write(self, img, filepath, max_edge):
+        if max_edge:
+            # reducing_gap先做整数倍box缩小，大图生成缩略图的开销很小
+            img.thumbnail((max_edge, max_edge), Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+        if filepath.endswith(".jpg"):
+            if img.mode == "RGBA":
+                img = img.convert("RGB")
+            self._save_atomic(img, filepath, "JPEG", quality=PREVIEW_JPEG_QUALITY)
+        else:
+            self._save_atomic(img, filepath, "PNG", compress_level=PREVIEW_COMPRESS_LEVEL)
+
+    def _save_atomic(self, image, filepath, format, **params):
+        """先写入临时文件再原子替换"""
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(image)
+        tmp_path = f"{filepath}.{threading.get_ident()}.tmp"
+        try:
+            image.save(tmp_path, format, **params)
+            os.replace(tmp_path, filepath)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+preview_writer = PreviewWriter()
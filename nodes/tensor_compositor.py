@@ -0,0 +1,295 @@
+"""
+基于torch张量的合成实现
+整个批次共享同一份布局，所有帧在输入所在的设备上一次完成变换与合成，
+全程保持浮点精度（预乘alpha），不经过PIL和uint8量化。
+
+与PIL后端的差异：
+- PIL路径每层都按8位量化，未缩放、未旋转的图层在不透明的输出像素上与PIL后端的误差
+  在 3/255 左右（多层叠加时累积），overlay/soft-light等非线性混合模式会放大量化误差，
+  最多约 10/255
+- 半透明像素的直通颜色由PIL在8位下还原，alpha越低误差越大：alpha > 0.25 时约 4/255，
+  alpha > 0.05 时约 12/255，接近全透明的像素RGB可能相差很大（几乎不可见）；
+  alpha通道本身的误差在 3/255 以内
+- 张量实现没有LANCZOS滤波器，以抗锯齿双三次插值代替，
+  因此缩放/旋转图层的边缘和细节会有可见但很小的差异
+"""
+import math
+import torch
+import torch.nn.functional as F
+from . import blend_modes
+from . import compositing
+from . import image_utils
+
+# grid_sample/interpolate不支持LANCZOS，用双三次代替
+TORCH_RESAMPLE_MODES = {
+    "lanczos": "bicubic",
+    "bicubic": "bicubic",
+    "bilinear": "bilinear",
+    "nearest": "nearest",
+}
+
+
+def to_rgba(images):
+    """将ComfyUI的IMAGE张量统一为RGBA
+
+    Args:
+        images: [B, H, W, C] 张量，C为1、3或4
+
+    Returns:
+        [B, H, W, 4] 浮点张量
+    """
+    if images.dim() == 3:
+        images = images.unsqueeze(0)
+
+    channels = images.shape[-1]
+    if channels == 4:
+        return images.float()
+    if channels == 1:
+        images = images.expand(-1, -1, -1, 3)
+    alpha = torch.ones_like(images[..., :1])
+    return torch.cat([images[..., :3], alpha], dim=-1).float()
+
+
+def batch_size_of(tensors):
+    """计算合成批次大小
+
+    单帧输入会广播到整个批次，其余输入的帧数必须一致。
+
+    Args:
+        tensors: 输入张量列表（可包含None）
+
+    Returns:
+        int: 批次大小
+    """
+    sizes = {t.shape[0] for t in tensors if t is not None and t.dim() == 4}
+    sizes.discard(1)
+    if len(sizes) > 1:
+        raise ValueError(f"[ImageCompositor] 输入批次大小不一致: {sorted(sizes)}，"
+                         f"只能混合单帧输入和相同帧数的输入")
+    return sizes.pop() if sizes else 1
+
+
+def premultiply(rgba):
+    """将直通alpha的RGBA张量转换为预乘alpha"""
+    return torch.cat([rgba[..., :3] * rgba[..., 3:], rgba[..., 3:]], dim=-1)
+
+
+def needs_lanczos(overlays, images_config, resample="lanczos"):
+    """是否有实际需要重采样（缩放或旋转）的图层使用LANCZOS滤波器
+
+    张量后端没有LANCZOS，这些图层只能以双三次代替；未缩放、未旋转的图层不重采样，不受影响。
+
+    Args:
+        overlays: 叠加图片张量列表（None表示空输入）
+        images_config: 叠加图层配置列表
+        resample: 节点级重采样滤波器
+
+    Returns:
+        bool
+    """
+    for img_index, config in image_utils.iter_layers(images_config):
+        if not 0 <= img_index < len(overlays) or overlays[img_index] is None:
+            continue
+        if image_utils.layer_resample(config, resample) != "lanczos":
+            continue
+        src_size = image_utils.image_size(overlays[img_index])
+        size, _, matrix = image_utils.layer_geometry(src_size, config)
+        if matrix is not None or size != src_size:
+            return True
+    return False
+
+
+def _resize(layer, size, mode):
+    """缩放 [B, 4, H, W] 张量到 size=(width, height)"""
+    width, height = size
+    if mode == "nearest":
+        return F.interpolate(layer, size=(height, width), mode="nearest")
+    return F.interpolate(layer, size=(height, width), mode=mode, align_corners=False, antialias=True)
+
+
+def _affine_resample(layer, size, matrix, mode):
+    """用一次grid_sample完成缩放、旋转和平移
+
+    Args:
+        layer: 预乘后的 [B, 4, H, W] 张量
+        size: 输出尺寸 (width, height)
+        matrix: 输出像素 -> 源图像素的仿射矩阵（见 image_utils.layer_geometry）
+        mode: grid_sample插值模式
+
+    Returns:
+        [B, 4, h, w] 张量
+    """
+    src_h, src_w = layer.shape[-2:]
+    width, height = size
+    a, b, c, d, e, f = matrix
+
+    # 输出像素中心对应的源图坐标，归一化到grid_sample的[-1, 1]
+    ys = torch.arange(height, device=layer.device, dtype=layer.dtype) + 0.5
+    xs = torch.arange(width, device=layer.device, dtype=layer.dtype) + 0.5
+    grid_y, grid_x = torch.meshgrid(ys, xs, indexing="ij")
+    src_x = a * grid_x + b * grid_y + c
+    src_y = d * grid_x + e * grid_y + f
+    grid = torch.stack([src_x / src_w * 2 - 1, src_y / src_h * 2 - 1], dim=-1)
+    grid = grid.unsqueeze(0).expand(layer.shape[0], -1, -1, -1)
+
+    return F.grid_sample(layer, grid, mode=mode, padding_mode="zeros", align_corners=False)
+
+
+def transform_layer(layer, config, resample="lanczos"):
+    """对整批图层应用尺寸和旋转变换（透明度在合成时应用）
+
+    Args:
+        layer: [B, H, W, 4] 图层张量
+        config: 图层配置（position/size/rotation/resample）
+        resample: 节点级重采样滤波器
+
+    Returns:
+        tuple: (预乘alpha的 [B, H', W', 4] 张量, 位置(x, y))
+    """
+    mode = TORCH_RESAMPLE_MODES[image_utils.layer_resample(config, resample)]
+
+    # 在预乘空间重采样，避免透明边缘出现色边
+    bchw = premultiply(layer).permute(0, 3, 1, 2)
+    src_size = (bchw.shape[-1], bchw.shape[-2])
+    size, pos, matrix = image_utils.layer_geometry(src_size, config)
+
+    resampled = size != src_size or matrix is not None
+    if matrix is None:
+        if size != src_size:
+            bchw = _resize(bchw, size, mode)
+    else:
+        # grid_sample不做抗锯齿：大幅缩小时先抗锯齿缩放，否则缩放、旋转、平移一次完成
+        scale = min(math.hypot(matrix[0], matrix[1]), math.hypot(matrix[3], matrix[4]))
+        if scale >= 2:
+            width = max(round(src_size[0] / scale), 1)
+            height = max(round(src_size[1] / scale), 1)
+            bchw = _resize(bchw, (width, height), mode)
+            size, pos, matrix = image_utils.layer_geometry((width, height), config)
+        bchw = _affine_resample(bchw, size, matrix, mode)
+
+    result = bchw.permute(0, 2, 3, 1)
+    if resampled:
+        # 双三次插值可能过冲，保证预乘颜色不超过alpha
+        alpha = result[..., 3:].clamp(0.0, 1.0)
+        result = torch.cat([torch.minimum(result[..., :3].clamp(min=0.0), alpha), alpha], dim=-1)
+
+    return result, pos
+
+
+def _cached_transform(overlay, config, resample, device, cache):
+    """变换图层，未变化的图层直接取缓存"""
+    key = None
+    if cache is not None:
+        key = ("torch", str(device), image_utils.tensor_fingerprint(overlay),
+               image_utils.transform_key(config, resample))
+        cached = cache.get(key, owner=overlay)
+        if cached is not None:
+            return cached[0], image_utils.cached_layer_position(overlay, config, cached[1])
+
+    layer, pos = transform_layer(to_rgba(overlay).to(device), config, resample)
+
+    if key is not None:
+        cache.put(key, (layer, pos), layer.numel() * layer.element_size(), owner=overlay)
+    return layer, pos
+
+
+def _blend(dst, src, mode, opacity):
+    """以指定混合模式将预乘图层合成到预乘画布区域（原地修改dst）"""
+    src_a = src[..., 3:]
+    dst_a = dst[..., 3:]
+    # 混合函数定义在直通alpha颜色上
+    cs = (src[..., :3] / src_a.clamp(min=1e-8)).clamp(0.0, 1.0)
+    cb = (dst[..., :3] / dst_a.clamp(min=1e-8)).clamp(0.0, 1.0)
+
+    sa = src_a * opacity
+    mixed = blend_modes.mix(cb, cs, dst_a, mode, torch)
+    rgb = sa * mixed + (1.0 - sa) * dst[..., :3]
+    alpha = sa + (1.0 - sa) * dst_a
+    dst.copy_(torch.cat([rgb, alpha], dim=-1))
+
+
+def alpha_over(canvas, layer, position, opacity=1.0, blend_mode="normal"):
+    """将预乘图层合成到预乘画布上，只处理图层包围盒与画布的交集
+
+    Args:
+        canvas: [B, H, W, 4] 预乘画布（原地修改）
+        layer: [B或1, h, w, 4] 预乘图层
+        position: 图层左上角位置 (x, y)
+        opacity: 图层整体透明度 (0-1)
+        blend_mode: 混合模式，未知模式按normal处理
+    """
+    boxes = compositing.clip_box((canvas.shape[2], canvas.shape[1]), position,
+                                 (layer.shape[2], layer.shape[1]))
+    if boxes is None:
+        return
+
+    (x0, y0, x1, y1), (sx0, sy0, sx1, sy1) = boxes
+    src = layer[:, sy0:sy1, sx0:sx1]
+    dst = canvas[:, y0:y1, x0:x1]
+    if blend_modes.is_blend_mode(blend_mode):
+        _blend(dst, src, blend_mode, opacity)
+    else:
+        dst.mul_(1.0 - opacity * src[..., 3:]).add_(src, alpha=opacity)
+
+
+def composite_batch(background, overlays, images_config, canvas_size=(1024, 1024), resample="lanczos",
+                    cache=None):
+    """批量合成：同一布局应用到批次中的每一帧
+
+    Args:
+        background: [B, H, W, C] 底图张量或None
+        overlays: 叠加图片张量列表（None表示空输入）
+        images_config: 叠加图层配置列表
+        canvas_size: 没有底图时的画布尺寸 (width, height)
+        resample: 默认重采样滤波器
+        cache: 变换后图层的LRUCache，None表示不使用缓存
+
+    Returns:
+        预乘alpha的画布张量 [B, H, W, 4]
+    """
+    batch = batch_size_of([background] + list(overlays))
+    tensors = [t for t in [background] + list(overlays) if t is not None]
+    device = tensors[0].device if tensors else torch.device("cpu")
+
+    if background is not None:
+        bg = to_rgba(background).to(device)
+        # 与PIL路径一致：以底图自身alpha为蒙版粘贴到透明画布
+        alpha = bg[..., 3:]
+        canvas = torch.cat([bg[..., :3] * alpha, alpha * alpha], dim=-1)
+        canvas = premultiply(canvas).expand(batch, -1, -1, -1).contiguous()
+    else:
+        width, height = canvas_size
+        canvas = torch.zeros((batch, height, width, 4), dtype=torch.float32, device=device)
+
+    for img_index, config in image_utils.iter_layers(images_config):
+        if not 0 <= img_index < len(overlays) or overlays[img_index] is None:
+            continue
+
+        layer, pos = _cached_transform(overlays[img_index], config, resample, device, cache)
+        alpha_over(canvas, layer, pos, config.get("opacity", 1.0), config.get("blendMode", "normal"))
+
+    return canvas
+
+
+def premultiplied_to_output(canvas, rgb_only=False):
+    """将预乘画布转换为ComfyUI的IMAGE和MASK输出
+
+    还原直通alpha的结果直接写入一次分配的输出张量，蒙版是输出alpha通道的视图。
+
+    Args:
+        canvas: 预乘alpha的画布张量 [B, H, W, 4]
+        rgb_only: 只输出RGB图像，蒙版取画布的alpha通道
+
+    Returns:
+        tuple: ([B, H, W, 4或3] 图像, [B, H, W] 蒙版)
+    """
+    alpha = canvas[..., 3:]
+    result = torch.empty(canvas.shape[:-1] + (3 if rgb_only else 4,), dtype=canvas.dtype, device=canvas.device)
+    rgb = result[..., :3]
+    torch.div(canvas[..., :3], alpha.clamp(min=1e-8), out=rgb)
+    rgb.masked_fill_(alpha <= 0, 0.0).clamp_(0.0, 1.0)
+
+    if rgb_only:
+        return result, canvas[..., 3]
+    result[..., 3:] = alpha
+    return result, result[..., 3]
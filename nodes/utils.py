@@ -6,6 +6,7 @@ import numpy as np
 from PIL import Image, ImageDraw, ImageFilter
 import json
 from typing import Optional, Tuple, List, Dict, Any
+from . import compositing
 
 
 def tensor_to_pil(tensor: torch.Tensor) -> Image.Image:
@@ -208,29 +209,18 @@ def apply_blend_mode(base: Image.Image,
         base: 基础图层
         overlay: 叠加图层
         position: 叠加位置
-        mode: 混合模式名称
+        mode: 混合模式名称（见 blend_modes.BLEND_MODES）
     
     Returns:
         混合后的图片
     """
-    result = base.copy()
+    # 只在叠加图层的包围盒内做混合运算
+    buffer = np.array(base.convert("RGBA"))
+    if not compositing.composite_layer(buffer, np.asarray(overlay.convert("RGBA")), position,
+                                       blend_mode=mode):
+        return base.copy()
     
-    temp = Image.new("RGBA", base.size, (0, 0, 0, 0))
-    temp.paste(overlay, position, overlay if overlay.mode == "RGBA" else None)
-    
-    if mode == "multiply":
-        result = Image.blend(result, temp, 0.5)
-    elif mode == "screen":
-        result = Image.blend(result, temp, 0.5)
-    elif mode == "overlay":
-        result = Image.blend(result, temp, 0.5)
-    else:
-        if overlay.mode == "RGBA":
-            result.paste(overlay, position, overlay)
-        else:
-            result.paste(overlay, position)
-    
-    return result
+    return Image.fromarray(buffer, "RGBA")
 
 
 def extract_mask(image: Image.Image) -> Optional[torch.Tensor]:
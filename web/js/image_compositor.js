@@ -14,6 +14,19 @@ const HandleType = {
     ROTATE: 'rotate'
 };
 
+// 图层混合模式：后端名称 -> [菜单标签, Canvas预览使用的globalCompositeOperation]
+const BlendModes = {
+    'normal': ['正常', 'source-over'],
+    'multiply': ['正片叠底', 'multiply'],
+    'screen': ['滤色', 'screen'],
+    'overlay': ['叠加', 'overlay'],
+    'soft-light': ['柔光', 'soft-light'],
+    'darken': ['变暗', 'darken'],
+    'lighten': ['变亮', 'lighten'],
+    'add': ['相加', 'lighter'],
+    'difference': ['差值', 'difference']
+};
+
 // Canvas编辑器类
 class CanvasEditor {
     constructor(canvas, node) {
@@ -927,14 +940,9 @@ class CanvasEditor {
             // 结束当前路径
             this.drawingCtx.stroke();
             
-            // 保存路径
+            // 保存路径（笔画列表即绘画层的保存格式，不能丢弃旧笔画）
             this.drawingPaths.push(this.currentPath);
             
-            // 限制路径数量（防止内存溢出）
-            if (this.drawingPaths.length > 100) {
-                this.drawingPaths.shift();
-            }
-            
             this.currentPath = null;
             this.updateNodeData();
         }
@@ -1036,6 +1044,11 @@ class CanvasEditor {
                 { label: '上移一层', action: () => this.bringForward() },
                 { label: '下移一层', action: () => this.sendBackward() },
                 { separator: true },
+                ...(clickedImage.isBackground ? [] : Object.entries(BlendModes).map(([mode, [label]]) => ({
+                    label: `${(clickedImage.blendMode || 'normal') === mode ? '✓ ' : ''}混合: ${label}`,
+                    action: () => this.setBlendMode(clickedImage, mode)
+                }))),
+                { separator: true },
                 { label: '属性...', action: () => this.showPropertiesPanel(clickedImage) }
             ];
             
@@ -1077,6 +1090,12 @@ class CanvasEditor {
     }
     
     // 图层操作
+    setBlendMode(img, mode) {
+        img.blendMode = mode;
+        this.renderComposite();
+        this.updateNodeData();
+    }
+    
     bringToFront() {
         if (this.selectedImage && !this.selectedImage.isBackground) {
             const index = this.images.indexOf(this.selectedImage);
@@ -1234,8 +1253,9 @@ class CanvasEditor {
                     this.ctx.translate(-cx, -cy);
                 }
                 
-                // 应用透明度
+                // 应用透明度和混合模式
                 this.ctx.globalAlpha = img.opacity || 1.0;
+                this.ctx.globalCompositeOperation = (BlendModes[img.blendMode] || BlendModes.normal)[1];
                 
                 // 绘制图片
                 this.ctx.drawImage(img.element, img.x, img.y, img.width, img.height);
@@ -1411,7 +1431,8 @@ class CanvasEditor {
         this.ctx.stroke();
     }
     
-    addImage(src, index, width = 150, height = 150) {
+    addImage(src, index, originalSize = null) {
+        // originalSize: 预览为缩略图时传入原图尺寸 {width, height}，坐标换算始终基于原图尺寸
         // 检查是否已经存在相同索引的图片
         const source = index === 0 ? 'background' : `input_${index}`;
         const existingIndex = this.images.findIndex(img => img.source === source);
@@ -1429,19 +1450,21 @@ class CanvasEditor {
             // 如果已存在但源不同，更新图片元素
             const img = new Image();
             img.onload = () => {
+                const naturalWidth = originalSize ? originalSize.width : img.naturalWidth;
+                const naturalHeight = originalSize ? originalSize.height : img.naturalHeight;
                 // 检查图片是否真的变化了
-                const sizeChanged = existing.originalWidth !== img.naturalWidth || 
-                                  existing.originalHeight !== img.naturalHeight;
+                const sizeChanged = existing.originalWidth !== naturalWidth || 
+                                  existing.originalHeight !== naturalHeight;
                 
                 existing.element = img;
-                existing.originalWidth = img.naturalWidth;
-                existing.originalHeight = img.naturalHeight;
+                existing.originalWidth = naturalWidth;
+                existing.originalHeight = naturalHeight;
                 
                 // 只有在图片尺寸发生变化时才重新计算（比如换了不同的图片）
                 if (sizeChanged) {
                     if (index === 0) {
                         // 背景图：以contain模式重新计算
-                        const bgAspect = img.naturalWidth / img.naturalHeight;
+                        const bgAspect = naturalWidth / naturalHeight;
                         const logicalWidth = this.canvas.width / this.dpr;
                         const logicalHeight = this.canvas.height / this.dpr;
                         const canvasAspect = logicalWidth / logicalHeight;
@@ -1460,7 +1483,7 @@ class CanvasEditor {
                     } else {
                         // 叠加图：保持相对比例调整大小
                         const oldAspect = existing.width / existing.height;
-                        const newAspect = img.naturalWidth / img.naturalHeight;
+                        const newAspect = naturalWidth / naturalHeight;
                         
                         // 如果宽高比变化，调整尺寸以保持新的比例
                         if (Math.abs(oldAspect - newAspect) > 0.01) {
@@ -1480,11 +1503,13 @@ class CanvasEditor {
         console.log(`[CanvasEditor] Adding new image ${source}`);
         const img = new Image();
         img.onload = () => {
+            const naturalWidth = originalSize ? originalSize.width : img.naturalWidth;
+            const naturalHeight = originalSize ? originalSize.height : img.naturalHeight;
             let imageData;
             
             if (index === 0) {
                 // 背景图：以contain模式显示（完整显示，保持比例）
-                const bgAspect = img.naturalWidth / img.naturalHeight;
+                const bgAspect = naturalWidth / naturalHeight;
                 const logicalWidth = this.canvas.width / this.dpr;
                 const logicalHeight = this.canvas.height / this.dpr;
                 const canvasAspect = logicalWidth / logicalHeight;
@@ -1510,8 +1535,8 @@ class CanvasEditor {
                     y: offsetY,
                     width: displayWidth,
                     height: displayHeight,
-                    originalWidth: img.naturalWidth,
-                    originalHeight: img.naturalHeight,
+                    originalWidth: naturalWidth,
+                    originalHeight: naturalHeight,
                     rotation: 0,
                     opacity: 1.0,
                     layer: 0,
@@ -1542,12 +1567,12 @@ class CanvasEditor {
                 
                 // 计算缩放比例，确保图片适合背景范围
                 const scale = Math.min(
-                    maxWidth / img.naturalWidth,
-                    maxHeight / img.naturalHeight,
+                    maxWidth / naturalWidth,
+                    maxHeight / naturalHeight,
                     1  // 不放大超过原始尺寸
                 );
-                const displayWidth = img.naturalWidth * scale;
-                const displayHeight = img.naturalHeight * scale;
+                const displayWidth = naturalWidth * scale;
+                const displayHeight = naturalHeight * scale;
                 
                 // 计算居中位置，带有偏移以区分多个图片
                 const offset = (index - 1) * 20;
@@ -1565,10 +1590,11 @@ class CanvasEditor {
                     y: y,
                     width: displayWidth,
                     height: displayHeight,
-                    originalWidth: img.naturalWidth,
-                    originalHeight: img.naturalHeight,
+                    originalWidth: naturalWidth,
+                    originalHeight: naturalHeight,
                     rotation: 0,
                     opacity: 1.0,
+                    blendMode: 'normal',
                     layer: index,
                     isBackground: false
                 };
@@ -1581,52 +1607,34 @@ class CanvasEditor {
         img.src = src;
     }
     
+    serializeDrawing(bgImage) {
+        // 将笔画转换为背景图原始像素坐标（与叠加图片坐标一致），由后端按输出分辨率栅格化
+        const scale = bgImage ? bgImage.width / bgImage.originalWidth : (this.canvas.width / this.dpr) / 1024;
+        const offsetX = bgImage ? bgImage.x : 0;
+        const offsetY = bgImage ? bgImage.y : 0;
+        const round = v => Math.round(v * 10) / 10;
+        
+        return {
+            width: bgImage ? bgImage.originalWidth : 1024,
+            height: bgImage ? bgImage.originalHeight : 1024,
+            strokes: this.drawingPaths.map(path => ({
+                tool: path.tool,
+                color: path.color,
+                size: round(path.size / scale),
+                opacity: path.opacity,
+                points: path.points.map(p => [round((p.x - offsetX) / scale), round((p.y - offsetY) / scale)])
+            }))
+        };
+    }
+    
     updateNodeData() {
         // 更新节点的composition_data
         const bgImage = this.images.find(img => img.isBackground);
         
-        // 将绘画层转换为base64数据
+        // 绘画层以矢量笔画列表保存
         let drawingData = null;
-        if (this.drawingCanvas && this.drawingPaths.length > 0) {
-            // 创建临时canvas来导出绘画层
-            const tempCanvas = document.createElement('canvas');
-            const tempCtx = tempCanvas.getContext('2d');
-            
-            // 设置尺寸（不含DPR，输出原始尺寸）
-            if (bgImage) {
-                tempCanvas.width = bgImage.originalWidth;
-                tempCanvas.height = bgImage.originalHeight;
-                
-                // 计算背景图的显示缩放比例和偏移
-                const displayScale = bgImage.width / bgImage.originalWidth;
-                const offsetX = bgImage.x;
-                const offsetY = bgImage.y;
-                
-                // 绘制绘画层内容，考虑背景图的偏移和缩放
-                // 1. 先将坐标系移动到背景图的原点
-                // 2. 然后应用缩放
-                const sourceX = offsetX * this.dpr;  // 源区域的起始X（考虑DPR）
-                const sourceY = offsetY * this.dpr;  // 源区域的起始Y（考虑DPR）
-                const sourceWidth = bgImage.width * this.dpr;  // 源区域的宽度（考虑DPR）
-                const sourceHeight = bgImage.height * this.dpr;  // 源区域的高度（考虑DPR）
-                
-                // 从绘画画布的背景图区域复制到输出画布
-                tempCtx.drawImage(
-                    this.drawingCanvas, 
-                    sourceX, sourceY, sourceWidth, sourceHeight,  // 源区域（背景图在画布上的位置）
-                    0, 0, bgImage.originalWidth, bgImage.originalHeight  // 目标区域（输出画布的完整区域）
-                );
-            } else {
-                tempCanvas.width = 1024;
-                tempCanvas.height = 1024;
-                // 没有背景图时，直接缩放整个绘画层
-                const scale = 1024 / (this.drawingCanvas.width / this.dpr);
-                tempCtx.scale(scale, scale);
-                tempCtx.drawImage(this.drawingCanvas, 0, 0, this.drawingCanvas.width / this.dpr, this.drawingCanvas.height / this.dpr);
-            }
-            
-            // 转换为base64
-            drawingData = tempCanvas.toDataURL('image/png');
+        if (this.drawingPaths.length > 0) {
+            drawingData = this.serializeDrawing(bgImage);
         }
         
         const data = {
@@ -1672,6 +1680,7 @@ class CanvasEditor {
                         size: { width: finalWidth, height: finalHeight },
                         rotation: img.rotation || 0,
                         opacity: img.opacity || 1.0,
+                        blendMode: img.blendMode || 'normal',
                         layer: index
                     };
                 }
@@ -1819,12 +1828,17 @@ app.registerExtension({
                     // 动态调整节点高度
                     // 基础高度（包含Canvas + input_count widget + padding）
                     const canvasHeight = 400;  // Canvas在节点内的显示高度
-                    const widgetHeight = 30;   // input_count widget的高度
+                    const widgetHeight = 30;   // 每个可见widget的高度
                     const inputHeight = 30;    // 每个输入槽的高度
                     const padding = 20;        // 额外padding
                     
+                    // 可见widget数量（不含隐藏的composition_data和Canvas本身）
+                    const widgetCount = (this.widgets || []).filter(
+                        w => w.type !== "hidden" && w.name !== "canvas_display"
+                    ).length;
+                    
                     // 计算总高度
-                    const newHeight = canvasHeight + widgetHeight + (targetCount * inputHeight) + padding;
+                    const newHeight = canvasHeight + (widgetCount * widgetHeight) + (targetCount * inputHeight) + padding;
                     
                     // 设置新的节点大小
                     this.size[0] = Math.max(this.size[0], 420);
@@ -1875,7 +1889,8 @@ app.registerExtension({
                                     width: img.width,
                                     height: img.height,
                                     rotation: img.rotation,
-                                    opacity: img.opacity
+                                    opacity: img.opacity,
+                                    blendMode: img.blendMode
                                 };
                             }
                         });
@@ -2082,6 +2097,19 @@ app.registerExtension({
                 
                 // onExecuted只处理运行后的结果更新，不处理实时预览
                 // 实时预览由onConnectionsChange和updateCanvasFromInputs处理
+                // 上游节点没有可用预览时，使用节点输出的缩略图（按原图尺寸换算坐标）
+                const previews = message?.images || [];
+                for (const preview of previews) {
+                    if (!preview.image || !preview.original_size) continue;
+                    if (this.canvasEditor.images.some(img => img.source === preview.type)) continue;
+                    
+                    const index = preview.type === 'background' ? 0 : parseInt(preview.type.replace('input_', ''));
+                    if (isNaN(index)) continue;
+                    
+                    const [width, height] = preview.original_size;
+                    const url = api.apiURL(`/view?filename=${encodeURIComponent(preview.image)}&type=temp`);
+                    this.canvasEditor.addImage(url, index, { width, height });
+                }
             });
         }
     }